@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import yamlio
+from keystore import KEYFILE, KeyPool, KeyStore, use_keystore
+
+
+SETUP_SUFFIXES = (".yaml", ".yml", ".json")
+
+
+class BatchResult(NamedTuple):
+    name: str
+    root: str
+    seconds: float
+    written: int = 0
+    error: Optional[str] = None
+
+
+def iter_documents(source: str) -> Iterator[Tuple[str, Optional[Dict], Optional[str]]]:
+    """Yields (name, document, error) for every setup in source
+
+    Source is either a directory of setup documents (named after their file)
+    or a JSONL stream with one setup per line (named after the setup, `-`
+    reads from stdin). A document that can't be parsed is yielded with its
+    error instead, so it fails on its own and not the whole batch.
+    """
+    if os.path.isdir(source):
+        for file in sorted(os.listdir(source)):
+            name, suffix = os.path.splitext(file)
+            if suffix in SETUP_SUFFIXES:
+                try:
+                    with open(os.path.join(source, file), "r") as f:
+                        yield name, yamlio.load(f), None
+                except Exception:
+                    yield name, None, traceback.format_exc()
+
+    else:
+        stream = sys.stdin if source == "-" else open(source, "r")
+        with stream:
+            for number, line in enumerate(stream, 1):
+                if line.strip():
+                    try:
+                        document = json.loads(line)
+                        yield str(document["name"]), document, None
+                    except Exception:
+                        yield f"line-{number}", None, traceback.format_exc()
+
+
+_key_pool: Optional[KeyPool] = None
+
+
+def _init_worker(keys: int):
+    global _key_pool
+    # Warm the heavy imports once per worker instead of once per setup
+    import main  # noqa: F401
+
+    _key_pool = KeyPool(keys, refill=True)
+
+
+def bake_document(name: str, document: Dict, root: str, **kwargs) -> BatchResult:
+    from main import bake_setup
+    from setup import Setup
+
+    start = time.perf_counter()
+    try:
+        with use_keystore(KeyStore(os.path.join(root, KEYFILE), pool=_key_pool)):
+            manifest = bake_setup(Setup(**document), root, **kwargs)
+    except Exception:
+        return BatchResult(name=name, root=root, seconds=time.perf_counter() - start, error=traceback.format_exc())
+
+    return BatchResult(name=name, root=root, seconds=time.perf_counter() - start, written=len(manifest.written))
+
+
+def bake_many(source: str, output: str, workers: Optional[int] = None, keys: int = 0, **kwargs) -> Iterator[BatchResult]:
+    """Bakes every setup in source into output/<name> on a pool of workers
+
+    Results are yielded as the setups finish, a failing setup is reported
+    in its result and doesn't abort the batch.
+    """
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(keys,)) as pool:
+        futures = []
+        for name, document, error in iter_documents(source):
+            if error is not None:
+                yield BatchResult(name=name, root=os.path.join(output, name), seconds=0.0, error=error)
+                continue
+
+            futures.append(pool.submit(bake_document, name, document, os.path.join(output, name), **kwargs))
+
+        for future in as_completed(futures):
+            yield future.result()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Bakes many setups, each into its own output root")
+    parser.add_argument("source", help="Directory of setup documents or a JSONL stream (- for stdin)")
+    parser.add_argument("output", help="Directory that receives one baked root per setup")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--keys", type=int, default=0, help="Pre-generate this many key pairs per worker")
+    parser.add_argument("--report", default=None, help="Write the per setup results as JSON to this file")
+    args = parser.parse_args()
+
+    results: List[BatchResult] = []
+    for result in bake_many(args.source, args.output, workers=args.workers, keys=args.keys):
+        results.append(result)
+        status = "failed" if result.error else f"{result.written} artifacts changed"
+        print(f"{result.name}: {status} in {result.seconds:.3f}s")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump([result._asdict() for result in sorted(results)], f, indent=2)
+
+    failed = [result for result in results if result.error]
+    for result in failed:
+        print(f"\n{result.name} failed:\n{result.error}", file=sys.stderr)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,99 @@
+"""Times and memory-profiles validation and every bake phase at several scales
+
+    python benchmarks/bench_bake.py --scales 10,1000,100000 --output bench.json
+
+Every scale is a synthetic setup with that many users, apps and groups. The
+results are written as JSON (one record per scale and phase) so they can be
+compared across commits.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from keystore import generate_key_pair  # noqa: E402
+from setup import Setup  # noqa: E402
+from sinks import DirectorySink  # noqa: E402
+from synthetic import generate_setup  # noqa: E402
+
+
+def measure(function, memory: bool = True):
+    if memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, {"seconds": seconds, "peak_bytes": peak}
+
+
+def run_scale(scale: int, key_pair, memory: bool = True):
+    config = generate_setup(
+        users=scale,
+        apps=scale,
+        groups=scale,
+        services={"lok": {"public_key": key_pair.public_key, "private_key": key_pair.private_key}},
+    )
+
+    records = []
+
+    def record(phase, function):
+        result, stats = measure(function, memory)
+        records.append({"scale": scale, "phase": phase, **stats})
+        return result
+
+    with tempfile.TemporaryDirectory() as root:
+        setup = record("validate", lambda: Setup(**config))
+        sink = DirectorySink(os.path.join(root, "phases"))
+
+        record("resolve", setup.resolve)
+        record("generate_configs", lambda: setup.generate_configs(sink))
+        record("generate_fakts", lambda: setup.generate_fakts(sink))
+        record("generate_files", lambda: setup.generate_files(sink))
+        record("generate_dev", lambda: setup.generate_dev(sink))
+        record("generate_compose", lambda: setup.generate_compose(sink))
+
+        fresh = Setup(**config)
+        record("bake", lambda: fresh.bake(os.path.join(root, "bake")))
+
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks validation and baking of synthetic setups")
+    parser.add_argument("--scales", default="10,1000,100000", help="Comma separated roster sizes")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc (it slows everything down)")
+    parser.add_argument("--output", default=None, help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    key_pair = generate_key_pair()
+    results = []
+    for scale in (int(scale) for scale in args.scales.split(",")):
+        for record in run_scale(scale, key_pair, memory=not args.no_memory):
+            print(f"{record['scale']:>8} {record['phase']:<18} {record['seconds']:.4f}s", file=sys.stderr)
+            results.append(record)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
@@ -0,0 +1,68 @@
+"""Compares the serializer against the old json round trip + remove_none chain
+
+    python benchmarks/bench_serializer.py --users 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serializer  # noqa: E402
+from setup import App, Group, User  # noqa: E402
+from utils import guard_empty  # noqa: E402
+
+
+def remove_none(obj):
+    if isinstance(obj, (list, tuple, set)):
+        return type(obj)(remove_none(x) for x in obj if guard_empty(x))
+    elif isinstance(obj, dict):
+        return type(obj)((k, remove_none(v)) for k, v in obj.items() if k and guard_empty(v))
+    else:
+        return obj
+
+
+def round_trip(roster):
+    return yaml.dump(remove_none(json.loads(json.dumps({key: [item.dict() for item in items] for key, items in roster.items()}))))
+
+
+def single_pass(roster):
+    return serializer.dump(roster)
+
+
+def measure(function, roster):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = function(roster)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return output, seconds, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    args = parser.parse_args()
+
+    roster = {
+        "groups": [Group(name=f"group{i}", description="A group") for i in range(max(1, args.users // 100))],
+        "users": [User(username=f"user{i}", email=f"user{i}@example.com", password="password", groups=[f"group{i // 100}"]) for i in range(args.users)],
+        "apps": [App(name=f"app{i}", identifier=f"io.example.app{i}", version="latest", tenant=f"user{i}") for i in range(max(1, args.users // 10))],
+    }
+
+    old, old_seconds, old_peak = measure(round_trip, roster)
+    new, new_seconds, new_peak = measure(single_pass, roster)
+
+    assert old == new, "Serializer output differs from the round trip"
+
+    print(json.dumps({
+        "users": args.users,
+        "round_trip": {"seconds": old_seconds, "peak_bytes": old_peak},
+        "serializer": {"seconds": new_seconds, "peak_bytes": new_peak},
+    }, indent=2))
@@ -0,0 +1,71 @@
+"""Guards the cold start of the baker against import time regressions
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter (best
+of a few runs), compares the cumulative import time against a budget and
+checks that none of the heavy modules, which are only needed on some code
+paths, sneak back into the import. Exits non zero on a violation, so it can
+run in CI or before building the image:
+
+    python benchmarks/importtime.py
+    python benchmarks/importtime.py --module main --budget-ms 300
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported lazily where they are needed (key generation, process pools, random usernames)
+FORBIDDEN = ("django", "git", "jwcrypto", "cryptography", "namegenerator", "concurrent.futures.process", "asyncio")
+
+# Generous enough for slow CI machines, a heavy import blows through them anyway
+BUDGETS_MS = {"setup": 400, "main": 450, "batch": 450, "watch": 450}
+
+# The batch runner always bakes on a process pool
+ALLOWED = {"batch": {"concurrent.futures.process"}}
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$")
+
+
+def measure(module: str) -> Tuple[float, Dict[str, int]]:
+    """The cumulative import time of module (ms) and every module it imported (us)"""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, capture_output=True, text=True, cwd=ROOT)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    imported = {}
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            imported[match.group(4)] = int(match.group(2))
+
+    return imported.get(module, 0) / 1000, imported
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Checks the import time of the baker against a budget")
+    parser.add_argument("--module", action="append", help="Modules to check (default: setup, main, batch and watch)")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Budget for every module instead of the defaults")
+    parser.add_argument("--runs", type=int, default=5, help="Take the best of this many runs")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.module or list(BUDGETS_MS):
+        budget = args.budget_ms or BUDGETS_MS.get(module, 450)
+        runs = [measure(module) for _ in range(args.runs)]
+        best, imported = min(runs, key=lambda run: run[0])
+
+        heavy = sorted(name for name in imported if (name.split(".")[0] in FORBIDDEN or name in FORBIDDEN) and name not in ALLOWED.get(module, ()))
+        ok = best <= budget and not heavy
+        failed = failed or not ok
+
+        print(f"{'ok  ' if ok else 'FAIL'} {module:8} {best:7.1f} ms (budget {budget:.0f} ms)")
+        for name in heavy:
+            print(f"     imports {name} at import time")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,70 @@
+"""Synthetic setups for the benchmarks, shaped like init/setup.yaml"""
+from typing import Dict, List, Optional
+
+
+SERVICES = [
+    {"name": "redis", "interface": "redis", "requires": []},
+    {"name": "postgres", "interface": "db", "requires": []},
+    {"name": "minio", "interface": "minio", "requires": []},
+    {"name": "rabbitmq", "interface": "rabbitmq", "requires": []},
+    {"name": "lok", "interface": "lok", "requires": ["redis", "db", "minio"]},
+    {"name": "mikro", "interface": "mikro", "requires": ["redis", "lok", "db", "minio"]},
+    {"name": "rekuest", "interface": "rekuest", "requires": ["redis", "lok", "db", "rabbitmq"]},
+    {"name": "fluss", "interface": "fluss", "requires": ["redis", "lok", "db", "minio"]},
+    {"name": "port", "interface": "port", "requires": ["redis", "lok", "db", "minio"]},
+    {"name": "orkestrator", "interface": "orkestrator", "requires": []},
+    {"name": "vscode", "interface": "vscode", "requires": []},
+]
+
+
+def generate_services(extras: Optional[Dict[str, Dict]] = None) -> List[Dict]:
+    extras = extras or {}
+    return [
+        {
+            **service,
+            "description": f"The {service['name']}",
+            "long": f"Synthetic {service['name']} service",
+            **extras.get(service["name"], {}),
+        }
+        for service in SERVICES
+    ]
+
+
+def generate_setup(users: int = 10, apps: int = 10, groups: int = 10, name: str = "synthetic", **extras) -> Dict:
+    """Generates a setup document with the given roster sizes
+
+    Every user is member of one group and every app is held by one user, so
+    all cross references resolve.
+    """
+    groups = max(groups, 1)
+    users = max(users, 1)
+
+    return {
+        "name": name,
+        "admin_username": "admin",
+        "admin_password": "admin",
+        "admin_email": "admin@example.com",
+        "services": generate_services(extras.pop("services", None)),
+        "groups": [{"name": f"group{i}", "description": f"Group {i}"} for i in range(groups)],
+        "users": [
+            {
+                "username": f"user{i}",
+                "email": f"user{i}@lab{i % 100}.example.com",
+                "password": f"password{i}",
+                "groups": [f"group{i % groups}"],
+            }
+            for i in range(users)
+        ],
+        "apps": [
+            {
+                "name": f"app{i}",
+                "identifier": f"io.example.app{i}",
+                "version": "latest",
+                "tenant": f"user{i % users}",
+                "redirect_uris": [f"http://localhost:{8000 + i % 1000}"],
+                "scopes": ["read", "write"],
+            }
+            for i in range(apps)
+        ],
+        **extras,
+    }
@@ -0,0 +1,166 @@
+import os
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import NamedTuple, Optional
+import threading
+
+
+# The name of the keyfile in the root of a bake
+KEYFILE = ".lok-key.pem"
+
+
+class KeyPair(NamedTuple):
+    private_key: str
+    public_key: str
+
+
+def generate_key_pair() -> KeyPair:
+    from cryptography.hazmat.primitives import serialization as crypto_serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.hazmat.backends import default_backend as crypto_default_backend
+
+    key = rsa.generate_private_key(
+        backend=crypto_default_backend(),
+        public_exponent=65537,
+        key_size=2048
+    )
+
+    return KeyPair(
+        private_key=key.private_bytes(
+            crypto_serialization.Encoding.PEM,
+            crypto_serialization.PrivateFormat.PKCS8,
+            crypto_serialization.NoEncryption()
+        ).decode(),
+        public_key=key.public_key().public_bytes(
+            crypto_serialization.Encoding.OpenSSH,
+            crypto_serialization.PublicFormat.OpenSSH
+        ).decode(),
+    )
+
+
+def load_key_pair(private_key: str) -> KeyPair:
+    from cryptography.hazmat.primitives import serialization as crypto_serialization
+    from cryptography.hazmat.backends import default_backend as crypto_default_backend
+
+    key = crypto_serialization.load_pem_private_key(private_key.encode(), password=None, backend=crypto_default_backend())
+
+    return KeyPair(
+        private_key=private_key,
+        public_key=key.public_key().public_bytes(
+            crypto_serialization.Encoding.OpenSSH,
+            crypto_serialization.PublicFormat.OpenSSH
+        ).decode(),
+    )
+
+
+class KeyPool:
+    """A pool of pre-generated key pairs
+
+    Generating a 2048 bit key is by far the most expensive step of a bake,
+    batch runs can fill a pool upfront (or in a worker initializer) and hand
+    out one fresh pair per setup. With `refill` a background thread tops the
+    pool up to its size after every take, so long running workers don't fall
+    back to generating keys while a setup waits.
+    """
+
+    def __init__(self, size: int = 0, refill: bool = False):
+        self.size = size
+        self.refill = refill
+        self._keys = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self.fill(size)
+
+    def fill(self, size: int):
+        for _ in range(size - len(self._keys)):
+            pair = generate_key_pair()
+            with self._lock:
+                self._keys.append(pair)
+
+    def take(self) -> KeyPair:
+        with self._lock:
+            pair = self._keys.popleft() if self._keys else None
+
+        if self.refill:
+            self._start_refill()
+
+        return pair or generate_key_pair()
+
+    def _start_refill(self):
+        with self._lock:
+            if self._refilling or len(self._keys) >= self.size:
+                return
+            self._refilling = True
+
+        threading.Thread(target=self._refill, name="keypool-refill", daemon=True).start()
+
+    def _refill(self):
+        try:
+            # Takes may happen meanwhile, keep going until the pool is full
+            while len(self._keys) < self.size:
+                self.fill(self.size)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class KeyStore:
+    """Lazily provides the key pair of a deployment
+
+    The pair is only created when a service actually asks for it. It is first
+    looked up in the keyfile, then taken from the pool (or generated) and
+    persisted to the keyfile so that later bakes reuse it. Without a path the
+    pair only lives as long as the store.
+    """
+
+    def __init__(self, path: Optional[str] = None, pool: Optional[KeyPool] = None):
+        self.path = path
+        self.pool = pool or KeyPool()
+        self._pair: Optional[KeyPair] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> KeyPair:
+        with self._lock:
+            if self._pair is None:
+                self._pair = self._load() or self._create()
+
+            return self._pair
+
+    def _load(self) -> Optional[KeyPair]:
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                return load_key_pair(f.read())
+
+        return None
+
+    def _create(self) -> KeyPair:
+        pair = self.pool.take()
+
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(pair.private_key)
+
+        return pair
+
+
+# Unset, a bake uses the keyfile under its root
+_current_keystore: ContextVar[Optional[KeyStore]] = ContextVar("keystore", default=None)
+
+
+def get_keystore() -> Optional[KeyStore]:
+    return _current_keystore.get()
+
+
+@contextmanager
+def use_keystore(keystore: KeyStore):
+    token = _current_keystore.set(keystore)
+    try:
+        yield keystore
+    finally:
+        _current_keystore.reset(token)
@@ -1,29 +1,112 @@
-import yaml
-import json
+import argparse
+import contextlib
+import logging
+import os
+import sys
+from typing import List, Optional
+import serializer
+import tracing
+import trusted
+import yamlio
 from setup import Setup
+from sinks import ArchiveSink, Sink, archive_format
 
 
+def roster_paths(setup: Setup) -> List[str]:
+    return [roster.path for roster in (setup.user_roster, setup.app_roster) if roster]
+
+
+def load_setup(path: str) -> Setup:
+    with tracing.span("load", path=path):
+        with open(path, "r") as f:
+            extended_config = yamlio.load(f)
+
+    with tracing.span("validate"):
+        return Setup(**extended_config)
+
+
+def load_trusted(source: bytes, path: str) -> Optional[Setup]:
+    """Rebuilds the setup from validated.yaml without validating it again
+
+    Returns None if there is no validated setup or it was not derived from
+    source (and the current environment).
+    """
+    expected = trusted.read_hash(path)
+    if expected is None:
+        return None
+
+    with tracing.span("load_trusted", path=path) as span:
+        with open(path, "r") as f:
+            data = yamlio.safe_load(f)
+
+        setup = trusted.construct(Setup, data)
+        setup.master_secret = trusted.master_secret(source)
+        current = trusted.source_hash(source, roster_paths(setup)) == expected
+        span.set(current=current)
+
+    return setup if current else None
+
+
+def write_validated(setup: Setup, root: str = "init", source_hash: Optional[str] = None):
+    os.makedirs(root, exist_ok=True)
+    with tracing.span("write", path="validated.yaml"):
+        with open(os.path.join(root, "validated.yaml"), "w") as f:
+            if source_hash:
+                f.write(f"{trusted.HASH_PREFIX}{source_hash}\n")
+            serializer.dump(setup, f, prune=False)
+
+
+def bake_setup(setup: Setup, root: str = "init", source_hash: Optional[str] = None, **kwargs) -> Sink:
+    write_validated(setup, root, source_hash)
+    return setup.bake(root, **kwargs)
+
 
-    
 if __name__ == "__main__":
 
-    # t
-    with open("init/setup.yaml", "r") as f:
-        extended_config = yaml.load(f, yaml.BaseLoader)
+    parser = argparse.ArgumentParser(description="Bakes init/setup.yaml into the init directory")
+    parser.add_argument("--workers", type=int, default=None, help="Write artifacts from a thread pool of this size")
+    parser.add_argument("--processes", type=int, default=None, help="Render service configs in a process pool of this size")
+    parser.add_argument("--trace", default=None, help="Write a trace of the bake to this file")
+    parser.add_argument("--trace-format", choices=["json", "chrome"], default="json", help="Plain JSON spans or Chrome trace events")
+    parser.add_argument("--trace-memory", action="store_true", help="Record the peak memory of every span (slow)")
+    parser.add_argument("--output", default=None, help="Stream the baked tree into this tar, tar.gz or zip archive (- for a tar on stdout) instead of init")
+    parser.add_argument("--revalidate", action="store_true", help="Validate setup.yaml even if validated.yaml is current")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level, DEBUG also logs resolved dependencies")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper())
+
+    tracer = tracing.Tracer(memory=args.trace_memory) if args.trace else tracing.NullTracer()
 
+    # Keep stdout clean when the archive is streamed to it
+    out = sys.stderr if args.output == "-" else sys.stdout
 
-    setup = Setup(**extended_config)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(tracing.use_tracer(tracer))
+        with open("init/setup.yaml", "rb") as f:
+            source = f.read()
 
+        setup = None if args.revalidate else load_trusted(source, "init/validated.yaml")
 
-    print("Validating")
-    with open("init/validated.yaml", "w") as f:
-        yaml.safe_dump(json.loads(setup.json()), f)
+        if setup is None:
+            print("Validating", file=out)
+            setup = load_setup("init/setup.yaml")
+            write_validated(setup, source_hash=trusted.source_hash(source, roster_paths(setup)))
+        else:
+            print("Using the validated setup", file=out)
 
+        sink = None
+        if args.output == "-":
+            sink = ArchiveSink(sys.stdout.buffer)
+        elif args.output:
+            sink = ArchiveSink(stack.enter_context(open(args.output, "wb")), archive_format(args.output))
 
+        manifest = setup.bake(workers=args.workers, processes=args.processes, sink=sink)
 
-    setup.bake()
+    if args.trace:
+        tracer.export(args.trace, args.trace_format)
 
-    print("Sucessfully baked the project")
+    print(f"Sucessfully baked the project ({len(manifest.written)} artifacts changed)", file=out)
 
 
 
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, Optional, Union
+
+import tracing
+
+
+MANIFEST_FILE = ".bake-manifest.json"
+
+
+def hash_content(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class BakeManifest:
+    """Keeps track of what a bake wrote under its root
+
+    Every artifact is recorded with the hash of its rendered content (and the
+    stat of the file we left behind). On a rebake an artifact is only written
+    if its content changed, so unchanged files keep their mtime and inode and
+    watchers or bind mounts don't see any churn. Artifacts that are no longer
+    produced are removed on `prune`.
+    """
+
+    def __init__(self, root: str = "init"):
+        self.root = root
+        self.path = os.path.join(root, MANIFEST_FILE)
+        self.previous = self._load()
+        self.artifacts: Dict[str, Dict] = {}
+        self.services: Dict[str, str] = {}
+        self.written = []
+
+    def _load(self) -> Dict:
+        try:
+            with open(self.path, "r") as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return {"artifacts": {}, "services": {}}
+
+        previous.setdefault("artifacts", {})
+        previous.setdefault("services", {})
+        return previous
+
+    def is_current(self, path: str, digest: str) -> bool:
+        entry: Optional[Dict] = self.previous["artifacts"].get(path)
+        if entry is None or entry["sha256"] != digest:
+            return False
+
+        try:
+            stat = os.stat(os.path.join(self.root, path))
+        except OSError:
+            return False
+
+        if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+
+        # Touched since the last bake, only rewrite if the content differs
+        with open(os.path.join(self.root, path), "r") as f:
+            return hash_content(f.read()) == digest
+
+    def write(self, path: str, content: Union[str, Iterable[str]]) -> bool:
+        """Writes content to path (relative to the root) if it changed
+
+        Content can also be an iterable of chunks, which are streamed into a
+        temporary file that only replaces the artifact if its hash changed.
+
+        Returns:
+            bool: Whether the file was written
+        """
+        with tracing.span("write", path=path) as span:
+            full_path = os.path.join(self.root, path)
+
+            if isinstance(content, str):
+                data = content.encode()
+                digest = hashlib.sha256(data).hexdigest()
+                changed = not self.is_current(path, digest)
+
+                if changed:
+                    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                    with open(full_path, "wb") as f:
+                        f.write(data)
+                size = len(data)
+
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                partial_path = full_path + ".partial"
+                hasher = hashlib.sha256()
+                size = 0
+                with open(partial_path, "wb") as f:
+                    for chunk in content:
+                        data = chunk.encode()
+                        hasher.update(data)
+                        f.write(data)
+                        size += len(data)
+
+                digest = hasher.hexdigest()
+                changed = not self.is_current(path, digest)
+                if changed:
+                    os.replace(partial_path, full_path)
+                else:
+                    os.remove(partial_path)
+
+            if changed:
+                self.written.append(path)
+
+            span.set(bytes=size if changed else 0, changed=changed)
+
+        stat = os.stat(full_path)
+        self.artifacts[path] = {"sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        return changed
+
+    def record_service(self, name: str, content: str):
+        self.services[name] = hash_content(content)
+
+    def changed_services(self):
+        return sorted(name for name, digest in self.services.items() if self.previous["services"].get(name) != digest)
+
+    def prune(self):
+        for path in self.previous["artifacts"]:
+            if path not in self.artifacts:
+                try:
+                    os.remove(os.path.join(self.root, path))
+                except FileNotFoundError:
+                    pass
+                self._remove_empty_dirs(os.path.dirname(path))
+
+    def _remove_empty_dirs(self, directory: str):
+        """Removes directory and its parents (below root) for as long as they are empty"""
+        while directory:
+            try:
+                os.rmdir(os.path.join(self.root, directory))
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"artifacts": self.artifacts, "services": self.services}, f, indent=2, sort_keys=True)
@@ -1,27 +1,9 @@
+import os
 import secrets
-from jwcrypto import jwk
+import hashlib
+import hmac
 import string
-import namegenerator
-from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
-
-key = rsa.generate_private_key(
-    backend=crypto_default_backend(),
-    public_exponent=65537,
-    key_size=2048
-)
-
-private_key = key.private_bytes(
-    crypto_serialization.Encoding.PEM,
-    crypto_serialization.PrivateFormat.PKCS8,
-    crypto_serialization.NoEncryption()
-).decode()
-
-public_key = key.public_key().public_bytes(
-    crypto_serialization.Encoding.OpenSSH,
-    crypto_serialization.PublicFormat.OpenSSH
-).decode()
+from typing import Optional
 
 generate_random_client_id = lambda: secrets.token_hex(16)
 generate_random_client_secret = lambda: secrets.token_hex(32)
@@ -30,4 +12,81 @@ alphabet = string.ascii_letters + string.digits
 
 generate_random_password = lambda: secrets.token_hex(16)
 
-generate_random_username = lambda: namegenerator.gen().replace("-", "")
+
+def generate_random_username() -> str:
+    import namegenerator  # only needed without a master secret
+
+    return namegenerator.gen().replace("-", "")
+
+
+# Same alphabet and length as django.core.management.utils.get_random_secret_key
+django_alphabet = "abcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*(-_=+)"
+generate_random_secret_key = lambda: "".join(secrets.choice(django_alphabet) for _ in range(50))
+
+
+def load_local_secret(path: str) -> str:
+    """A random secret kept in path (created on first use) that stands in for a master secret"""
+    try:
+        with open(path, "r") as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
+
+    secret = secrets.token_hex(32)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(secret)
+
+    return secret
+
+
+def hkdf(master: str, info: str, length: int) -> bytes:
+    """HKDF-SHA256 (RFC 5869) without salt"""
+    prk = hmac.new(b"\x00" * hashlib.sha256().digest_size, master.encode(), hashlib.sha256).digest()
+
+    okm, block, counter = b"", b"", 1
+    while len(okm) < length:
+        block = hmac.new(prk, block + info.encode() + bytes([counter]), hashlib.sha256).digest()
+        okm += block
+        counter += 1
+
+    return okm[:length]
+
+
+def derive_string(master: str, path: str, chars: str, length: int) -> str:
+    # Rejection sampling keeps every character uniformly distributed
+    limit = 256 - (256 % len(chars))
+    out, counter = [], 0
+    while len(out) < length:
+        for byte in hkdf(master, f"{path}#{counter}", length * 2):
+            if byte < limit and len(out) < length:
+                out.append(chars[byte % len(chars)])
+        counter += 1
+
+    return "".join(out)
+
+
+SECRET_KINDS = {
+    "client_id": (generate_random_client_id, lambda master, path: hkdf(master, path, 16).hex()),
+    "client_secret": (generate_random_client_secret, lambda master, path: hkdf(master, path, 32).hex()),
+    "token": (generate_random_token, lambda master, path: hkdf(master, path, 100).hex()),
+    "password": (generate_random_password, lambda master, path: hkdf(master, path, 16).hex()),
+    "username": (generate_random_username, lambda master, path: derive_string(master, path, string.ascii_lowercase, 16)),
+    "django": (generate_random_secret_key, lambda master, path: derive_string(master, path, django_alphabet, 50)),
+}
+
+
+def generate_secret(kind: str, master: Optional[str] = None, path: str = "") -> str:
+    """Generates a secret of kind, derived from master and path if a master is set
+
+    Derived secrets only depend on the master secret and their path (e.g.
+    "mysetup/services/postgres/password"), so rebaking reproduces them.
+    """
+    generate, derive = SECRET_KINDS[kind]
+    if master is None:
+        return generate()
+
+    return derive(master, f"{kind}:{path}")
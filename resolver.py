@@ -0,0 +1,76 @@
+from collections import deque
+from typing import Dict, List, Sequence, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from setup import BaseService
+
+
+def build_provider_index(services: Sequence["BaseService"]) -> Dict[str, "BaseService"]:
+    """Maps every required interface to the one service providing it
+
+    Raises:
+        ValueError: If a required interface has no provider or more than one
+    """
+    providers: Dict[str, List["BaseService"]] = {}
+    for service in services:
+        providers.setdefault(service.interface, []).append(service)
+
+    index = {}
+    errors = []
+    for service in services:
+        for interface in service.requires:
+            candidates = providers.get(interface, [])
+            if len(candidates) == 0:
+                errors.append(f"{service.name} requires {interface} but no service provides it")
+            elif len(candidates) > 1:
+                errors.append(f"{service.name} requires {interface} which is provided by {', '.join(candidate.name for candidate in candidates)}")
+            else:
+                index[interface] = candidates[0]
+
+    if errors:
+        raise ValueError("Could not resolve the services: " + "; ".join(errors))
+
+    return index
+
+
+def resolution_layers(services: Sequence["BaseService"], index: Dict[str, "BaseService"]) -> List[List["BaseService"]]:
+    """Orders the services topologically along their requirements
+
+    Every service only appears in a layer after all of its providers, within
+    a layer the order of the setup is kept.
+
+    Raises:
+        ValueError: If the requirements contain a cycle
+    """
+    providers = {id(service): {id(index[interface]) for interface in service.requires} - {id(service)} for service in services}
+
+    # Kahn's algorithm over the reverse edges, every edge is looked at once
+    in_degree = {key: len(provided_by) for key, provided_by in providers.items()}
+    dependents: Dict[int, List["BaseService"]] = {}
+    for service in services:
+        for provider in providers[id(service)]:
+            dependents.setdefault(provider, []).append(service)
+
+    depth = {}
+    ready = deque(service for service in services if in_degree[id(service)] == 0)
+    for service in ready:
+        depth[id(service)] = 0
+
+    while ready:
+        service = ready.popleft()
+        for dependent in dependents.get(id(service), ()):
+            depth[id(dependent)] = max(depth.get(id(dependent), 0), depth[id(service)] + 1)
+            in_degree[id(dependent)] -= 1
+            if in_degree[id(dependent)] == 0:
+                ready.append(dependent)
+
+    if any(in_degree.values()):
+        remaining = [service for service in services if in_degree[id(service)]]
+        raise ValueError("Could not resolve the services, their requirements form a cycle: " + ", ".join(f"{service.name} -> {service.requires}" for service in remaining))
+
+    # A layer holds the services of one depth, bucketed in the order of the setup
+    layers: List[List["BaseService"]] = [[] for _ in range(max(depth.values(), default=-1) + 1)]
+    for service in services:
+        layers[depth[id(service)]].append(service)
+
+    return layers
@@ -0,0 +1,151 @@
+import csv
+import json
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Set
+
+from pydantic import errors
+from pydantic.networks import validate_email
+
+
+# The dot-atom local parts nearly every address has, everything else goes
+# through the full validation
+SIMPLE_LOCAL_PART = re.compile(r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*")
+
+MAX_REPORTED_ERRORS = 50
+
+# Columns of a csv roster that hold lists, their items are separated by ;
+LIST_COLUMNS = {"groups", "redirect_uris", "scopes"}
+
+
+@lru_cache(maxsize=None)
+def _validate_domain(domain: str) -> Optional[str]:
+    try:
+        return validate_email(f"user@{domain}")[1].split("@", 1)[1]
+    except errors.EmailError:
+        return None
+
+
+def normalize_email(email: str) -> Optional[str]:
+    """Validates and normalizes an email like pydantic's EmailStr
+
+    The domain is validated once per distinct domain. Returns None if the
+    address is invalid.
+    """
+    email = email.strip()
+    local, at, domain = email.rpartition("@")
+
+    if at and len(local) <= 64 and SIMPLE_LOCAL_PART.fullmatch(local):
+        domain = _validate_domain(domain)
+        return f"{local}@{domain}" if domain else None
+
+    try:
+        return validate_email(email)[1]
+    except errors.EmailError:
+        return None
+
+
+class RosterIndex:
+    """Validates users, groups and apps in one pass with hash indexes
+
+    Items can be added one by one (e.g. while streaming them from a file),
+    every problem is collected instead of stopping at the first one.
+    """
+
+    def __init__(self, admin_username: Optional[str] = None):
+        self.admin_username = admin_username
+        self.groups: Set[str] = set()
+        self.usernames: Set[str] = set()
+        self.emails: Dict[str, str] = {}
+        self.client_ids: Set[str] = set()
+        self.first_username: Optional[str] = None
+        self.errors: List[str] = []
+        self._pending_group_checks: List = []
+
+    def add_group(self, group):
+        if group.name in self.groups:
+            self.errors.append(f"Group {group.name} is defined more than once")
+        self.groups.add(group.name)
+
+    def add_user(self, user):
+        if user.username in self.usernames:
+            self.errors.append(f"User {user.username} is defined more than once")
+        self.usernames.add(user.username)
+        if self.first_username is None:
+            self.first_username = user.username
+
+        email = normalize_email(user.email)
+        if email is None:
+            self.errors.append(f"User {user.username} has an invalid email address {user.email!r}")
+        else:
+            user.email = email
+            key = email.lower()
+            if key in self.emails:
+                self.errors.append(f"User {user.username} has the same email as {self.emails[key]}")
+            else:
+                self.emails[key] = user.username
+
+        unknown = [group for group in user.groups if group not in self.groups]
+        if unknown:
+            self._pending_group_checks.append((user.username, unknown))
+
+    def add_app(self, app):
+        if app.client_id in self.client_ids:
+            self.errors.append(f"App {app.name} reuses the client_id of another app")
+        self.client_ids.add(app.client_id)
+
+        if app.tenant is None:
+            if self.first_username is None:
+                self.errors.append(f"App {app.name} has no tenant, you need to have at least one user installed")
+                return
+            app.tenant = self.first_username
+
+        if app.tenant == self.admin_username:
+            self.errors.append(f"App {app.name} should not be hold by admin account")
+        elif app.tenant not in self.usernames:
+            self.errors.append(f"App {app.name} has unknown tenant {app.tenant}")
+
+    def check_groups(self):
+        """Checks the group memberships (groups can be defined after their users)"""
+        for username, groups in self._pending_group_checks:
+            for group in groups:
+                if group not in self.groups:
+                    self.errors.append(f"User {username} is member of unknown group {group}")
+
+        self._pending_group_checks = []
+
+    def raise_errors(self):
+        self.check_groups()
+
+        if self.errors:
+            reported = self.errors[:MAX_REPORTED_ERRORS]
+            if len(self.errors) > MAX_REPORTED_ERRORS:
+                reported.append(f"... and {len(self.errors) - MAX_REPORTED_ERRORS} more")
+
+            raise ValueError(f"Invalid roster ({len(self.errors)} errors):\n" + "\n".join(reported))
+
+
+def iter_records(path: str, format: Optional[str] = None) -> Iterator[Dict]:
+    """Streams the records of a roster file (csv or jsonl) one by one
+
+    Empty csv cells are left out so that the model defaults apply.
+    """
+    format = format or os.path.splitext(path)[1].lstrip(".").lower()
+
+    with open(path, "r", newline="") as f:
+        if format == "csv":
+            for row in csv.DictReader(f):
+                yield {
+                    key: [item.strip() for item in value.split(";") if item.strip()] if key in LIST_COLUMNS else value
+                    for key, value in row.items()
+                    if key and value not in (None, "")
+                }
+
+        elif format in ("jsonl", "ndjson"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+        else:
+            raise ValueError(f"Unknown roster format {format} for {path}, use csv or jsonl")
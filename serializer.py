@@ -0,0 +1,79 @@
+import json
+from enum import Enum
+from typing import Any, Dict, IO, Iterable, Iterator, Optional
+
+from pydantic import BaseModel
+
+import yamlio
+from utils import guard_empty
+
+
+def _is_empty(obj) -> bool:
+    if isinstance(obj, BaseModel):
+        return len(obj.__fields__) == 0
+
+    return not guard_empty(obj)
+
+
+def _key(key) -> str:
+    return key if isinstance(key, str) else json.dumps(key)
+
+
+def to_plain(obj: Any, prune: bool = True) -> Any:
+    """Turns pydantic models (and whatever they contain) into plain yaml data
+
+    This is a single walk over the tree that yields the same data as a
+    `json.loads(json.dumps(model.dict()))` round trip. With `prune`, empty
+    values (None and empty containers) and falsy keys are dropped on the way,
+    like `remove_none` used to do. Fields declared with `exclude=True` (e.g.
+    secrets) are never dumped.
+    """
+    if isinstance(obj, BaseModel):
+        items = ((key, getattr(obj, key)) for key, field in obj.__fields__.items() if field.field_info.exclude is not True)
+    elif isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple, set)):
+        return [to_plain(item, prune) for item in obj if not (prune and _is_empty(item))]
+    elif isinstance(obj, Enum):
+        return obj.value
+    elif isinstance(obj, str):
+        return str(obj)
+    else:
+        return obj
+
+    if prune:
+        return {_key(key): to_plain(value, prune) for key, value in items if key and not _is_empty(value)}
+
+    return {_key(key): to_plain(value, prune) for key, value in items}
+
+
+def dump(obj: Any, stream: Optional[IO] = None, prune: bool = True) -> Optional[str]:
+    """Dumps obj as yaml, either into stream or as a string"""
+    return yamlio.dump(to_plain(obj, prune), stream)
+
+
+def dump_chunks(obj: Any, streams: Dict[str, Iterable], prune: bool = True) -> Iterator[str]:
+    """Dumps obj as yaml chunk by chunk, with some of its keys fed from streams
+
+    The items of every stream are serialized one at a time, so a roster
+    never has to be held in memory as a whole. The chunks join to the same
+    document `dump` would produce with the streamed lists in place.
+    """
+    plain = to_plain(obj, prune)
+
+    for key in sorted(set(plain) | set(streams)):
+        if key not in streams:
+            yield yamlio.dump({key: plain[key]})
+            continue
+
+        empty = True
+        for item in streams[key]:
+            if prune and _is_empty(item):
+                continue
+            if empty:
+                yield f"{key}:\n"
+                empty = False
+            yield yamlio.dump([to_plain(item, prune)])
+
+        if empty and not prune:
+            yield yamlio.dump({key: []})
@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import io
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import yamlio
+from keystore import KeyPool, KeyStore, use_keystore
+
+
+logger = logging.getLogger(__name__)
+
+
+MAX_BODY = 64 * 1024 * 1024
+
+ARCHIVE_TYPES = {"tar": "application/x-tar", "tar.gz": "application/gzip", "zip": "application/zip"}
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 422: "Unprocessable Entity", 500: "Internal Server Error"}
+
+Response = Tuple[int, str, bytes]
+
+# They point at files on the host of the server, which a request must never read
+ROSTER_FIELDS = ("user_roster", "app_roster")
+
+
+def json_response(status: int, data) -> Response:
+    return status, "application/json", json.dumps(data, default=str).encode()
+
+
+_key_pool: Optional[KeyPool] = None
+
+
+def _init_worker(keys: int):
+    global _key_pool
+    # Warm the heavy imports and keys once per worker instead of once per request
+    import setup  # noqa: F401
+
+    _key_pool = KeyPool(keys, refill=True)
+
+
+def parse_document(body: bytes, content_type: str) -> Dict:
+    if "json" in content_type:
+        return json.loads(body)
+
+    return yamlio.load(body.decode())
+
+
+def run_job(action: str, body: bytes, content_type: str, format: str = "json") -> Response:
+    """Validates or bakes one setup document (runs in a worker process)
+
+    Every job gets its own in memory keystore, fed by the warm pool of the
+    worker, so nothing is written to disk. Nothing is read from it either,
+    setups that reference rosters are rejected.
+    """
+    import pydantic
+    import serializer
+    from setup import Setup
+    from sinks import ArchiveSink, MemorySink
+
+    try:
+        document = parse_document(body, content_type)
+    except Exception as e:
+        return json_response(400, {"error": f"Could not parse the setup: {e}"})
+
+    if not isinstance(document, dict):
+        return json_response(400, {"error": "The setup has to be a mapping"})
+
+    rosters = [field for field in ROSTER_FIELDS if document.get(field)]
+    if rosters:
+        return json_response(422, {"valid": False, "errors": [{"loc": [field], "msg": "Rosters are not accepted over the api, inline the users and apps instead"} for field in rosters]})
+
+    try:
+        with use_keystore(KeyStore(None, pool=_key_pool)):
+            setup = Setup(**document)
+
+            if action == "validate":
+                return json_response(200, {"valid": True, "setup": serializer.to_plain(setup, prune=False)})
+
+            start = time.perf_counter()
+            if format == "json":
+                sink = MemorySink()
+            else:
+                stream = io.BytesIO()
+                sink = ArchiveSink(stream, format)
+
+            sink.write("validated.yaml", serializer.dump(setup, prune=False))
+            setup.bake(sink=sink)
+            logger.info("Baked %s in %.3fs", setup.name, time.perf_counter() - start)
+
+    except pydantic.ValidationError as e:
+        return json_response(422, {"valid": False, "errors": e.errors()})
+    except ValueError as e:
+        return json_response(422, {"valid": False, "errors": [{"msg": str(e)}]})
+
+    if format == "json":
+        return json_response(200, {"written": sink.written, "artifacts": {path: data.decode() for path, data in sink.files.items()}})
+
+    return 200, ARCHIVE_TYPES[format], stream.getvalue()
+
+
+class BakeServer:
+    """Serves validation and bakes of setups over HTTP from a warm process
+
+        POST /validate               the setup (yaml or json) -> the validated setup or its errors
+        POST /bake?format=json       the setup -> every artifact as JSON
+        POST /bake?format=tar        ... as a tar (or tar.gz, zip) archive of the init tree
+        GET  /healthz
+
+    The CPU heavy part of every request runs on a bounded process pool,
+    requests beyond the pool size queue up while other connections are
+    still served.
+    """
+
+    def __init__(self, workers: Optional[int] = None, keys: int = 0, max_pending: int = 64):
+        self.pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(keys,))
+        self.pending = asyncio.Semaphore(max_pending)
+
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str], body: bytes) -> Response:
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+
+        if url.path == "/healthz":
+            return json_response(200, {"ok": True})
+
+        if url.path not in ("/validate", "/bake"):
+            return json_response(404, {"error": f"No route {url.path}"})
+
+        if method != "POST":
+            return json_response(405, {"error": f"{url.path} only accepts POST"})
+
+        format = query.get("format", ["json"])[0]
+        if format != "json" and format not in ARCHIVE_TYPES:
+            return json_response(400, {"error": f"Unknown format {format}, use json, tar, tar.gz or zip"})
+
+        async with self.pending:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, run_job, url.path.lstrip("/"), body, headers.get("content-type", ""), format)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    status, content_type, payload = json_response(413, {"error": f"The setup may not exceed {MAX_BODY} bytes"})
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    try:
+                        status, content_type, payload = await self.dispatch(method, target, headers, body)
+                    except Exception as e:
+                        logger.exception("Request failed")
+                        status, content_type, payload = json_response(500, {"error": str(e)})
+                    keep_alive = headers.get("connection", "").lower() != "close"
+
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                )
+                writer.write(payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8090):
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.warning("Serving on %s:%s", host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serves validation and bakes of setups over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8090, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=None, help="Size of the process pool that validates and bakes")
+    parser.add_argument("--keys", type=int, default=2, help="Key pairs every worker generates upfront")
+    parser.add_argument("--max-pending", type=int, default=64, help="Requests that may wait for a worker at once")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper())
+
+    async def main():
+        await BakeServer(args.workers, args.keys, args.max_pending).serve(args.host, args.port)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
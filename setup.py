@@ -1,15 +1,23 @@
-from typing import Dict, List
-from pydantic import BaseModel, EmailStr, Field, root_validator
+from typing import Dict, List, Tuple, Type
+from pydantic import BaseModel, EmailStr, Field, PrivateAttr, root_validator
 from typing import Optional
-from mysecrets import generate_random_password, public_key, private_key, generate_random_username, generate_random_client_id, generate_random_client_secret, generate_random_token
-from typing import Any, Literal, Union
+from mysecrets import load_local_secret, generate_random_password, generate_random_username, generate_random_client_id, generate_random_client_secret, generate_random_token, generate_random_secret_key, generate_secret
+from typing import Any, Iterable, Iterator, Literal, Union
+import re
+import secrets
+import typing
 import os
 import itertools
-import shutil
-import yaml 
-from utils import remove_none, guard_empty, create_config_mount, create_dev_mount, create_fakts_mount, create_docker_mount
-import json
-from django.core.management.utils import get_random_secret_key
+import logging
+import contextlib
+from concurrent.futures import Executor, ThreadPoolExecutor
+from keystore import KEYFILE, KeyStore, get_keystore
+from sinks import DirectorySink, Sink
+from roster import RosterIndex, iter_records, normalize_email
+from resolver import build_provider_index, resolution_layers
+import tracing
+from utils import create_config_mount, create_dev_mount, create_fakts_mount, create_docker_mount, parse_size
+import serializer
 import pydantic
 from enum import Enum
 
@@ -44,6 +52,19 @@ FLUSS_MULTIPLATFORM_IMAGE = "jhnnsrs/fluss:prodx"
 PORT_IMAGE = "jhnnsrs/port:prod"
 PORT_MULTIPLATFORM_IMAGE = "jhnnsrs/port:prodx"
 
+PGBOUNCER_IMAGE = "edoburu/pgbouncer:latest"
+PGBOUNCER_MULTIPLATFORM_IMAGE = "edoburu/pgbouncer:latest"
+
+NGINX_IMAGE = "nginx:stable-alpine"
+NGINX_MULTIPLATFORM_IMAGE = "nginx:stable-alpine"
+
+
+logger = logging.getLogger(__name__)
+
+
+# Next to the keyfile, holds the secret that stands in for a missing master secret
+LOCAL_SECRET_FILE = ".guss-secret"
+
 
 
 
@@ -67,7 +88,31 @@ class DockerService(BaseModel):
     command: Optional[str]
     depends_on: Union[List[str], Dict[str, Any]] = Field(default_factory=list)
     labels: Optional[List[str]]
+    deploy: Optional["DockerDeploy"]
+    shm_size: Optional[str]
+    # Scale like another docker service (e.g. all nodes of a cluster), not by name
+    _scale_as: Optional[str] = PrivateAttr(default=None)
+    # The replicated docker service a balancer fronts
+    _balances: Optional[str] = PrivateAttr(default=None)
+
+
+
+class DockerResourceSpec(BaseModel):
+    cpus: Optional[str]
+    memory: Optional[str]
+
 
+class DockerResources(BaseModel):
+    limits: Optional[DockerResourceSpec]
+    reservations: Optional[DockerResourceSpec]
+
+
+class DockerDeploy(BaseModel):
+    replicas: Optional[int]
+    resources: Optional[DockerResources]
+
+
+DockerService.update_forward_refs()
 
 
 class DockerDriverOpts(BaseModel):
@@ -101,7 +146,7 @@ class Group(BaseModel):
 
 class User(BaseModel):
     username: str
-    email: pydantic.EmailStr
+    email: str  # validated in bulk by the roster of the setup
     password: str
     groups: List[str] = Field(default_factory=list)
 
@@ -116,6 +161,10 @@ class GrantType(str, Enum):
     CLIENT_CREDENTIALS = "client-credentials"
 
 
+# Names that end up in the paths of prerendered fakts (fakts/clients/<client_id>/<binding>.yaml)
+SAFE_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+
 class App(BaseModel):
     name: str
     identifier: str
@@ -136,6 +185,12 @@ class AdminUser(BaseModel):
     password: str
 
 
+class RosterFile(BaseModel):
+    """An external csv or jsonl roster (the format is inferred from the suffix)"""
+    path: str
+    format: Optional[Literal["csv", "jsonl"]] = None
+
+
 class Binding(BaseModel):
     name: str
     host: str
@@ -144,6 +199,97 @@ class Binding(BaseModel):
 
 
 
+class ServiceScale(BaseModel):
+    """How one docker service is scaled, unset fields are left to docker"""
+    replicas: Optional[int] = None
+    cpus: Optional[float] = None
+    memory: Optional[str] = None
+    reserve_cpus: Optional[float] = None
+    reserve_memory: Optional[str] = None
+    # Processes per container, passed as WEB_CONCURRENCY (read by gunicorn and uvicorn)
+    workers: Optional[int] = None
+
+    def to_deploy(self) -> Optional[DockerDeploy]:
+        limits = DockerResourceSpec(cpus=str(self.cpus) if self.cpus else None, memory=self.memory)
+        reservations = DockerResourceSpec(cpus=str(self.reserve_cpus) if self.reserve_cpus else None, memory=self.reserve_memory)
+        resources = DockerResources(
+            limits=limits if limits.cpus or limits.memory else None,
+            reservations=reservations if reservations.cpus or reservations.memory else None,
+        )
+
+        if self.replicas is None and resources.limits is None and resources.reservations is None:
+            return None
+
+        return DockerDeploy(replicas=self.replicas, resources=resources)
+
+
+STATELESS_SMALL = ServiceScale(replicas=1, cpus=1, memory="1g", workers=2)
+STATELESS_LARGE = ServiceScale(replicas=3, cpus=2, memory="2g", reserve_cpus=0.5, reserve_memory="512m", workers=4)
+
+# The built in scale profiles, per docker service
+SCALE_PROFILES: Dict[str, Dict[str, ServiceScale]] = {
+    "dev": {},
+    "small": {
+        "lok": ServiceScale(cpus=1, memory="1g", workers=2),
+        "mikro": STATELESS_SMALL,
+        "rekuest": STATELESS_SMALL,
+        "fluss": STATELESS_SMALL,
+        "port": STATELESS_SMALL,
+        "port-worker": ServiceScale(replicas=1, cpus=1, memory="1g"),
+        "db": ServiceScale(cpus=2, memory="2g", reserve_memory="1g"),
+        "pgbouncer": ServiceScale(cpus=0.5, memory="128m"),
+        "redis": ServiceScale(cpus=0.5, memory="512m"),
+        "redis-channels": ServiceScale(cpus=0.5, memory="256m"),
+        "redis-cache": ServiceScale(cpus=0.5, memory="512m"),
+        "rabbitmq": ServiceScale(cpus=1, memory="1g"),
+        "minio": ServiceScale(cpus=1, memory="2g"),
+        "minio-balancer": ServiceScale(cpus=1, memory="256m"),
+        "orkestrator": ServiceScale(cpus=0.5, memory="256m"),
+    },
+    "large": {
+        "lok": ServiceScale(replicas=2, cpus=2, memory="2g", reserve_cpus=0.5, reserve_memory="512m", workers=4),
+        "mikro": STATELESS_LARGE,
+        "rekuest": STATELESS_LARGE,
+        "fluss": STATELESS_LARGE,
+        "port": STATELESS_LARGE,
+        "port-worker": ServiceScale(replicas=4, cpus=2, memory="2g"),
+        "db": ServiceScale(cpus=8, memory="16g", reserve_cpus=2, reserve_memory="8g"),
+        "pgbouncer": ServiceScale(cpus=1, memory="256m"),
+        "redis": ServiceScale(cpus=2, memory="4g", reserve_memory="1g"),
+        "redis-channels": ServiceScale(cpus=1, memory="1g", reserve_memory="256m"),
+        "redis-cache": ServiceScale(cpus=4, memory="4g", reserve_memory="1g"),
+        "rabbitmq": ServiceScale(cpus=2, memory="4g", reserve_memory="1g"),
+        "minio": ServiceScale(cpus=4, memory="8g", reserve_memory="2g"),
+        "minio-balancer": ServiceScale(cpus=2, memory="512m"),
+        "orkestrator": ServiceScale(cpus=1, memory="512m"),
+    },
+}
+
+
+class Scale(BaseModel):
+    """The scale of the deployment: a profile plus overrides per docker service"""
+    value: str = "dev"
+    label: Optional[str]
+    icon: Optional[str]
+    description: Optional[str]
+    services: Dict[str, ServiceScale] = Field(default_factory=dict)
+
+    @root_validator()
+    def validate_profile(cls, values):
+        if values.get("value") not in SCALE_PROFILES and values.get("value") != "custom":
+            raise ValueError(f"Unknown scale {values.get('value')}, use one of {', '.join(SCALE_PROFILES)} or custom")
+        return values
+
+    def for_service(self, name: str) -> Optional[ServiceScale]:
+        scale = SCALE_PROFILES.get(self.value, {}).get(name)
+        override = self.services.get(name)
+
+        if override is not None:
+            return scale.copy(update=override.dict(exclude_none=True)) if scale else override
+
+        return scale
+
+
 class AdminUser(BaseModel):
     username: str
     password: str
@@ -161,18 +307,54 @@ class Fakt(BaseModel):
 
 
 
-def to_http_base(host: str, port: str, internal_lok: str = "lok", internal_port: str = None):
+class FaktRequest(BaseModel):
+    """A client request to the fakts endpoint that fakts are pre-rendered for"""
+    host: str
+    secure: bool = False
+
+
+def to_http_base(host: str, port: str, internal_lok: str = "lok", internal_port: str = None, request: Optional[FaktRequest] = None):
+    if request:
+        return f'{"https" if request.secure else "http"}://{host if request.host == internal_lok else request.host}:{port}'
+
     return '{{"https" if request.is_secure else "http" }}://{{"' + host + '" if request.host == "' + internal_lok + '" else request.host}}:' + str(port)
 
-def to_ws_base(host: str, port: str, internal_lok: str = "lok", internal_port: str = None):
+def to_ws_base(host: str, port: str, internal_lok: str = "lok", internal_port: str = None, request: Optional[FaktRequest] = None):
+    if request:
+        return f'{"wss" if request.secure else "ws"}://{host if request.host == internal_lok else request.host}:{port}'
+
     return '{{"wss" if request.is_secure else "ws" }}://{{"' + host + '" if request.host == "' + internal_lok + '" else request.host}}:' + str(port)
 
 
+class CacheSettings(BaseModel):
+    """How the django services cache and keep their sessions (shared through redis)"""
+    backend: str = "django.core.cache.backends.redis.RedisCache"
+    timeout: int = 300
+    # Per process, every worker of a service holds its own pool
+    max_connections: int = 20
+    session_engine: str = "django.contrib.sessions.backends.cached_db"
+
+
+class DjangoCache(BaseModel):
+    backend: str
+    location: str
+    key_prefix: str
+    timeout: int
+    max_connections: int
+
+
+class DjangoSession(BaseModel):
+    engine: str
+    cache_alias: str = "default"
+
+
 class DjangoConfig(BaseModel):
     debug: bool = False
     hosts: List[str] = ["*"]
     admin: AdminUser 
-    secret_key: str = Field(default_factory=get_random_secret_key)
+    secret_key: str = Field(default_factory=generate_random_secret_key)
+    cache: Optional[DjangoCache] = None
+    session: Optional[DjangoSession] = None
 
 
 
@@ -188,27 +370,36 @@ class BaseService(BaseModel):
     dependencies: Dict[str, Depend] = Field(default_factory=dict)
 
 
-    def resolve(self, setup: "Setup"):
-        print(f"Resolving {self.name} with {self.requires}")
+    def resolve(self, setup: "Setup", providers: Dict[str, "BaseService"]):
+        logger.info("Resolving %s with %s", self.name, self.requires)
         self.dependencies = {}
-        for service in setup.services:
-            if service.interface in self.requires:
-                print("Depending on", service)
-                self.dependencies[service.interface] = service.depend(self)
-               
+        for interface in self.requires:
+            service = providers[interface]
+            logger.debug("%s depends on %s through %s", self.name, service.name, interface)
+            self.dependencies[interface] = service.depend(self, setup)
 
-        print(self.dependencies)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Dependencies of %s: %s", self.name, self.dependencies)
         
     def create_dirs(self, setup: "Setup"):
         pass
 
-    def create_fakt(self, setup: "Setup") -> Fakt:
+    def create_fakt(self, setup: "Setup", request: Optional[FaktRequest] = None) -> Fakt:
+        """The fakt of this service, a template or rendered for request"""
         return None
     
     def create_raw_fakt(self, setup: "Setup") -> str:
         return None
 
+    def create_client_fakt(self, setup: "Setup", app: "App", request: FaktRequest) -> Fakt:
+        """The rendered fakt of this service for one client (the raw fakt's counterpart)"""
+        return None
+
     
+    def create_config_streams(self, setup: "Setup") -> Dict[str, Iterable]:
+        """Lists of the config that are streamed into it while it is written"""
+        return {}
+
     def create_config(self, setup: "Setup") -> BaseModel:
         """Also the place for validation
 
@@ -223,6 +414,47 @@ class BaseService(BaseModel):
     def create_docker_services(self, setup: "Setup") -> List[DockerService]:
         return []
 
+    def create_files(self, setup: "Setup") -> Dict[str, str]:
+        """Raw files (path relative to the init dir -> content) next to the yaml config"""
+        return {}
+
+    def patch_docker_services(self, setup: "Setup", docker_services: List[DockerService]):
+        """Adjusts the docker services of the whole setup (e.g. their dependencies)"""
+        pass
+
+    def create_django_config(self, setup: "Setup") -> DjangoConfig:
+        return DjangoConfig(
+            debug=self.dev is True,
+            admin=AdminUser(
+                username=setup.admin_username,
+                email=setup.admin_email,
+                password=setup.admin_password,
+            ),
+            secret_key=setup.generate_secret("django", "services", self.name, "django"),
+            cache=self.create_django_cache(setup),
+            session=DjangoSession(engine=setup.cache.session_engine) if "redis" in self.dependencies else None,
+        )
+
+    def create_django_cache(self, setup: "Setup") -> Optional[DjangoCache]:
+        """The cache shared by all workers and replicas of the service (through its redis)"""
+        redis = self.dependencies.get("redis")
+        if redis is None:
+            return None
+
+        if redis.cache is not None:
+            location = f"redis://{redis.cache.host}:{redis.cache.port}/{redis.cache.db or 0}"
+        else:
+            # Next to the channel layer, but on its own logical db
+            location = f"redis://{redis.host}:{redis.port}/{(redis.db or 0) + 1}"
+
+        return DjangoCache(
+            backend=setup.cache.backend,
+            location=location,
+            key_prefix=f"{setup.name}:{self.name}",
+            timeout=setup.cache.timeout,
+            max_connections=setup.cache.max_connections,
+        )
+
     def create_docker_volumes(self, setup: "Setup") -> List[DockerVolume]:
         return []
     
@@ -240,7 +472,7 @@ class BaseService(BaseModel):
 
 class GivingService(BaseService):
 
-    def depend(self, service: BaseService):
+    def depend(self, service: BaseService, setup: "Setup"):
         pass
 
 
@@ -270,7 +502,18 @@ class DbDepend(Depend):
     port: int
     db_name: str
     engine: str
+    # Set behind a transaction pooler, server side cursors don't survive across transactions
+    disable_server_side_cursors: Optional[bool] = None
+
+
+
+# Connections a single app server worker keeps open (persistent connections and some headroom)
+CONNECTIONS_PER_WORKER = 5
+
+# Superuser, maintenance and replication connections on top of the services
+RESERVED_CONNECTIONS = 20
 
+MB = 1024 ** 2
 
 
 class PostgresService(GivingService):
@@ -282,10 +525,38 @@ class PostgresService(GivingService):
 
     databases: List[str] = Field(default_factory=list)
 
-    def depend(self, service: BaseService):
+    tune: bool = True
+    # The budget postgres is tuned for, defaults to the limits of the scale profile
+    memory: Optional[str] = None
+    cpus: Optional[float] = None
+    ssd: bool = True
+    max_connections: Optional[int] = None
+    # Host path to keep the data in (a bind volume), otherwise it lives in the container
+    data_path: Optional[str] = None
+
+    # Opt in PgBouncer between the services and postgres
+    pooling: bool = False
+    pool_mode: Literal["transaction", "session"] = "transaction"
+    pool_size: int = 20
+    reserve_pool_size: int = 5
+    pooler_host: str = "pgbouncer"
+    pooler_port: int = 6432
+
+    def depend(self, service: BaseService, setup: "Setup"):
         database_name = f"{service.name}_db"
         self.databases.append(database_name)
 
+        if self.pooling:
+            return DbDepend(
+                username=self.username,
+                password=self.password,
+                port=self.pooler_port,
+                host=self.pooler_host,
+                db_name=database_name,
+                engine="django.db.backends.postgresql",
+                disable_server_side_cursors=self.pool_mode == "transaction" or None,
+            )
+
         return DbDepend(
             username=self.username,
             password=self.password,
@@ -295,27 +566,166 @@ class PostgresService(GivingService):
             engine="django.db.backends.postgresql"
         )
 
+    def client_connections(self, setup: "Setup") -> Dict[str, int]:
+        """The connections the services using each database can open at once"""
+        demand = {}
+        for database in sorted(set(self.databases)):
+            service_name = database[:-len("_db")]
+            demand[database] = 0
+            for docker_name in (service_name, f"{service_name}-worker"):
+                scale = setup.scale.for_service(docker_name)
+                if scale is not None or docker_name == service_name:
+                    demand[database] += ((scale and scale.replicas) or 1) * ((scale and scale.workers) or 1) * CONNECTIONS_PER_WORKER
+
+        return demand
+
+    def connection_demand(self, setup: "Setup") -> int:
+        """The connections postgres has to accept from the services (or the pooler)"""
+        if self.pooling:
+            return sum(min(self.pool_size, clients) + self.reserve_pool_size for clients in self.client_connections(setup).values())
+
+        return sum(self.client_connections(setup).values())
+
+    def budget(self, setup: "Setup") -> Tuple[int, float]:
+        """Memory (bytes) and cpus postgres is tuned for"""
+        scale = setup.scale.for_service(self.host)
+        memory = self.memory or (scale and scale.memory) or "1g"
+        cpus = self.cpus or (scale and scale.cpus) or 2
+        return parse_size(memory), cpus
+
+    def create_postgresql_conf(self, setup: "Setup") -> Dict[str, str]:
+        """Settings along the lines of pgtune for a web workload"""
+        memory, cpus = self.budget(setup)
+        cpus = max(1, int(cpus))
+        max_connections = self.max_connections or max(100, self.connection_demand(setup) + RESERVED_CONNECTIONS)
+
+        shared_buffers = memory // 4
+        parallel_per_gather = max(1, min(4, cpus // 2))
+        work_mem = max(64 * 1024, (memory - shared_buffers) // (max_connections * 3) // parallel_per_gather)
+
+        return {
+            "listen_addresses": "'*'",
+            "max_connections": str(max_connections),
+            "shared_buffers": f"{shared_buffers // MB}MB",
+            "effective_cache_size": f"{memory * 3 // 4 // MB}MB",
+            "maintenance_work_mem": f"{min(memory // 16, 2048 * MB) // MB}MB",
+            "work_mem": f"{work_mem // 1024}kB",
+            "wal_buffers": f"{max(1, min(16 * MB, shared_buffers * 3 // 100) // MB)}MB",
+            "min_wal_size": "1GB",
+            "max_wal_size": "4GB",
+            "checkpoint_completion_target": "0.9",
+            "default_statistics_target": "100",
+            "random_page_cost": "1.1" if self.ssd else "4",
+            "effective_io_concurrency": "200" if self.ssd else "2",
+            "max_worker_processes": str(cpus),
+            "max_parallel_workers_per_gather": str(parallel_per_gather),
+            "max_parallel_workers": str(cpus),
+            "max_parallel_maintenance_workers": str(max(1, min(4, cpus // 2))),
+        }
+
+    def create_pgbouncer_ini(self, setup: "Setup") -> str:
+        clients = self.client_connections(setup)
+
+        ini = "# Generated from the postgres service of the setup, changes are overwritten on the next bake\n"
+        ini += "[databases]\n"
+        for database, connections in clients.items():
+            ini += f"{database} = host={self.host} port={self.port} dbname={database} pool_size={min(self.pool_size, connections)}\n"
+
+        settings = {
+            "listen_addr": "0.0.0.0",
+            "listen_port": str(self.pooler_port),
+            "auth_type": "scram-sha-256",
+            "auth_file": "/etc/pgbouncer/userlist.txt",
+            "admin_users": self.username,
+            "pool_mode": self.pool_mode,
+            "max_client_conn": str(max(100, sum(clients.values()))),
+            "default_pool_size": str(self.pool_size),
+            "reserve_pool_size": str(self.reserve_pool_size),
+            "server_reset_query": "DISCARD ALL",
+            # Sent by psycopg2/Django on connect, pgbouncer refuses unknown startup parameters
+            "ignore_startup_parameters": "extra_float_digits,options",
+        }
+        ini += "\n[pgbouncer]\n" + "".join(f"{key} = {value}\n" for key, value in settings.items())
+        return ini
+
+    def create_files(self, setup: "Setup") -> Dict[str, str]:
+        files = {}
+
+        if self.tune:
+            settings = self.create_postgresql_conf(setup)
+            conf = "# Generated from the postgres service of the setup, changes are overwritten on the next bake\n"
+            conf += "".join(f"{key} = {value}\n" for key, value in settings.items())
+            files["configs/postgres.conf"] = conf
+
+        if self.pooling:
+            files["configs/pgbouncer/pgbouncer.ini"] = self.create_pgbouncer_ini(setup)
+            files["configs/pgbouncer/userlist.txt"] = f'"{self.username}" "{self.password}"\n'
+
+        return files
+
+    def patch_docker_services(self, setup: "Setup", docker_services: List[DockerService]):
+        if not self.pooling:
+            return
+
+        # Everything that waits for postgres needs to wait for the pooler it talks to
+        for docker_service in docker_services:
+            if docker_service.name != self.pooler_host and isinstance(docker_service.depends_on, list) and self.host in docker_service.depends_on:
+                docker_service.depends_on = [*docker_service.depends_on, self.pooler_host]
+
+    def create_docker_volumes(self, setup: "Setup") -> List[DockerVolume]:
+        if self.data_path:
+            return [DockerVolume.from_local(f"{self.host}_data", self.data_path)]
+
+        return []
+
     def create_docker_services(self, setup: "Setup") -> List[DockerService]:
 
         volumes = []
+        command = None
+        shm_size = None
 
         if self.dev:
             volumes.append(create_dev_mount(self.name))
 
-        return [
+        if self.data_path:
+            volumes.append(f"{self.host}_data:/var/lib/postgresql/data")
+
+        if self.tune:
+            volumes.append("./configs/postgres.conf:/etc/postgresql/postgresql.conf")
+            command = "postgres -c config_file=/etc/postgresql/postgresql.conf"
+            # Parallel workers and shared buffers live in /dev/shm, docker only grants 64m by default
+            memory, _ = self.budget(setup)
+            shm_size = f"{max(256, memory // 4 // MB)}m"
+
+        docker_services = [
             DockerService(
                 name="db", 
                 image=DATEN_MULTIPLATFORM_IMAGE if setup.multiplatform else DATEN_IMAGE,
                 volumes=volumes, 
+                command=command,
+                shm_size=shm_size,
                 environment={
                     "POSTGRES_USER": self.username,
                     "POSTGRES_PASSWORD": self.password,
-                    "POSTGRES_MULTIPLE_DATABASES": ", ".join(set(self.databases)),
+                    "POSTGRES_MULTIPLE_DATABASES": ", ".join(sorted(set(self.databases))),
                 },
                 depends_on=[],
                 labels=[f"arkitekt.{setup.name}.service=postgres"])
         ]
 
+        if self.pooling:
+            docker_services.append(
+                DockerService(
+                    name=self.pooler_host,
+                    image=PGBOUNCER_MULTIPLATFORM_IMAGE if setup.multiplatform else PGBOUNCER_IMAGE,
+                    volumes=["./configs/pgbouncer:/etc/pgbouncer"],
+                    command="pgbouncer /etc/pgbouncer/pgbouncer.ini",
+                    depends_on=["db"],
+                    labels=[f"arkitekt.{setup.name}.service=pgbouncer"])
+            )
+
+        return docker_services
+
 
 
 
@@ -336,7 +746,7 @@ class RabbitMQService(GivingService):
     password: str = "guest"
 
 
-    def depend(self, service: "Service"):
+    def depend(self, service: "Service", setup: "Setup"):
         return RabbitMQDepend(
             username=self.username,
             password=self.password,
@@ -361,9 +771,37 @@ class RabbitMQService(GivingService):
         ]
 
 
+class RedisEndpoint(BaseModel):
+    host: str
+    port: int
+    db: Optional[int] = None
+
+
 class RedisDepend(Depend):
     host: str
     port: int
+    # Only set when the redis service is split into roles
+    db: Optional[int] = None
+    role: Optional[str] = None
+    cache: Optional[RedisEndpoint] = None
+
+
+# What a role needs when it has an instance (or its settings) for itself
+REDIS_ROLE_DEFAULTS = {
+    "channels": {"maxmemory_policy": "noeviction", "persistence": "none"},
+    "cache": {"maxmemory_policy": "allkeys-lru", "persistence": "none"},
+}
+
+
+class RedisRole(BaseModel):
+    """A use of redis, either on its own instance or a logical db of the shared one"""
+    name: Literal["channels", "cache"]
+    separate: bool = False
+    db: Optional[int] = None
+    maxmemory: Optional[str] = None
+    maxmemory_policy: Optional[str] = None
+    persistence: Optional[Literal["none", "rdb", "aof"]] = None
+    io_threads: Optional[int] = None
 
 
 class RedisService(GivingService):
@@ -371,20 +809,170 @@ class RedisService(GivingService):
     host: str = "redis"
     port: int = 6379
 
-    def depend(self, service: BaseService):
-        return RedisDepend(host=self.host, port=self.port)
+    roles: List[RedisRole] = Field(default_factory=list)
+
+    # Settings of the shared instance, derived from its roles and the scale if unset
+    maxmemory: Optional[str] = None
+    maxmemory_policy: Optional[str] = None
+    persistence: Optional[Literal["none", "rdb", "aof"]] = None
+    io_threads: Optional[int] = None
+
+    @root_validator()
+    def validate_roles(cls, values):
+        roles = values.get("roles") or []
+        names = [role.name for role in roles]
+        if len(names) != len(set(names)):
+            raise ValueError("Every redis role may only be configured once")
+
+        dbs = [role.db for role in roles if not role.separate and role.db is not None]
+        if len(dbs) != len(set(dbs)):
+            raise ValueError("Roles sharing the redis instance need their own db")
+
+        # The channel layer must never lose messages to cache evictions
+        channels = next((role for role in roles if role.name == "channels"), None)
+        if channels and (channels.maxmemory_policy or "").startswith("allkeys"):
+            raise ValueError("The channels role can't use an allkeys eviction policy")
+        if (values.get("maxmemory_policy") or "").startswith("allkeys") and roles and not (channels and channels.separate):
+            raise ValueError("The shared redis carries the channel layer, it can't use an allkeys eviction policy")
+
+        return values
+
+    def effective_roles(self) -> List[RedisRole]:
+        """The configured roles, with channels on the shared instance unless configured"""
+        if not self.roles or any(role.name == "channels" for role in self.roles):
+            return list(self.roles)
+
+        return [RedisRole(name="channels"), *self.roles]
+
+    def has_shared_instance(self) -> bool:
+        roles = self.effective_roles()
+        return not roles or any(not role.separate for role in roles)
+
+    def role_host(self, role: RedisRole) -> str:
+        return f"{self.host}-{role.name}" if role.separate else self.host
+
+    def role_dbs(self) -> Dict[str, int]:
+        """The db of every role, roles on the shared instance never share one"""
+        roles = self.effective_roles()
+        dbs = {role.name: role.db for role in roles if role.db is not None}
+        taken = {db for name, db in dbs.items() if not next(role for role in roles if role.name == name).separate}
+
+        for role in roles:
+            if role.name in dbs:
+                continue
+            if role.separate:
+                dbs[role.name] = 0
+            else:
+                db = 0
+                while db in taken:
+                    db += 1
+                dbs[role.name] = db
+                taken.add(db)
+
+        return dbs
+
+    def endpoint(self, name: str) -> Optional[RedisEndpoint]:
+        for role in self.effective_roles():
+            if role.name == name:
+                return RedisEndpoint(host=self.role_host(role), port=self.port, db=self.role_dbs()[name])
+
+        return None
+
+    def depend(self, service: BaseService, setup: "Setup"):
+        if not self.roles:
+            return RedisDepend(host=self.host, port=self.port)
+
+        channels = self.endpoint("channels")
+        return RedisDepend(host=channels.host, port=channels.port, db=channels.db, role="channels", cache=self.endpoint("cache"))
+
+    def create_redis_command(self, setup: "Setup", docker_name: str, roles: List[RedisRole], instance: Optional[BaseModel] = None) -> Optional[str]:
+        """The redis-server command line for an instance serving roles
+
+        Explicit settings (of the instance) win, the rest is derived from what
+        the roles need and the memory/cpus the scale profile grants.
+        """
+        instance = instance or self
+        defaults = [REDIS_ROLE_DEFAULTS[role.name] for role in roles]
+        if not defaults and not any((instance.maxmemory, instance.maxmemory_policy, instance.persistence, instance.io_threads)):
+            return None
+
+        policy = instance.maxmemory_policy
+        if policy is None and defaults:
+            policies = {default["maxmemory_policy"] for default in defaults}
+            # Shared between channels and cache, only evict what expires anyway
+            policy = policies.pop() if len(policies) == 1 else "volatile-lru"
+
+        persistence = instance.persistence
+        if persistence is None and defaults:
+            # The most durable any of the roles asks for (or needs by default)
+            wanted = {role.persistence or default["persistence"] for role, default in zip(roles, defaults)}
+            persistence = next(level for level in ("aof", "rdb", "none") if level in wanted)
+
+        scale = setup.scale.for_service(docker_name)
+        maxmemory = parse_size(instance.maxmemory) if instance.maxmemory else None
+        if maxmemory is None and scale and scale.memory:
+            # Leave room for fragmentation and the copy on write of background saves
+            maxmemory = parse_size(scale.memory) * 3 // 4
+
+        io_threads = instance.io_threads
+        if io_threads is None and scale and scale.cpus and scale.cpus >= 4:
+            io_threads = min(8, int(scale.cpus) - 1)
+
+        command = ["redis-server"]
+        if maxmemory:
+            command += ["--maxmemory", f"{maxmemory // MB}mb"]
+        if policy:
+            command += ["--maxmemory-policy", policy]
+        if persistence == "none":
+            command += ["--save", '""', "--appendonly", "no"]
+        elif persistence == "rdb":
+            command += ["--appendonly", "no"]
+        elif persistence == "aof":
+            command += ["--appendonly", "yes", "--appendfsync", "everysec"]
+        if io_threads and io_threads > 1:
+            command += ["--io-threads", str(io_threads), "--io-threads-do-reads", "yes"]
+
+        return " ".join(command)
+
+    def patch_docker_services(self, setup: "Setup", docker_services: List[DockerService]):
+        separate = [self.role_host(role) for role in self.effective_roles() if role.separate]
+        if not separate:
+            return
+
+        for docker_service in docker_services:
+            if docker_service.name not in separate and isinstance(docker_service.depends_on, list) and self.interface in docker_service.depends_on:
+                shared = [self.interface] if self.has_shared_instance() else []
+                docker_service.depends_on = [*(name for name in docker_service.depends_on if name != self.interface), *shared, *separate]
 
     def create_docker_services(self, setup: "Setup") -> List[DockerService]:
+        roles = self.effective_roles()
+        docker_services = []
+
+        # Only if a role (or the plain setup without roles) still lives on it
+        if self.has_shared_instance():
+            docker_services.append(
+                DockerService(
+                    name=self.interface, 
+                    image=REDIS_MULTIPLATFORM_IMAGE if setup.multiplatform else REDIS_IMAGE, 
+                    command=self.create_redis_command(setup, self.interface, [role for role in roles if not role.separate]),
+                    ports=[], 
+                    volumes=[],  
+                    depends_on=[],
+                    labels=[f"arkitekt.{setup.name}.service=redis"])
+            )
 
-        return [
-            DockerService(
-                name=self.interface, 
-                image=REDIS_MULTIPLATFORM_IMAGE if setup.multiplatform else REDIS_IMAGE, 
-                ports=[], 
-                volumes=[],  
-                depends_on=[],
-                labels=[f"arkitekt.{setup.name}.service=redis"])
-        ]
+        for role in roles:
+            if role.separate:
+                docker_services.append(
+                    DockerService(
+                        name=self.role_host(role),
+                        image=REDIS_MULTIPLATFORM_IMAGE if setup.multiplatform else REDIS_IMAGE,
+                        command=self.create_redis_command(setup, self.role_host(role), [role], role),
+                        depends_on=[],
+                        labels=[f"arkitekt.{setup.name}.service=redis-{role.name}"])
+                )
+
+        return docker_services
     
 
 class OrkestratorService(GivingService):
@@ -442,13 +1030,34 @@ class MinioService(GivingService):
     buckets: List[Bucket] = Field(default_factory=list)
     users: List[MinioUser] = Field(default_factory=list)
 
-    def depend(self, service: "Service"):
+    # More than one drive in total runs minio distributed (erasure coded) behind a balancer
+    nodes: int = 1
+    drives: int = 1
+    data_path: Optional[str] = None
+
+    @root_validator()
+    def validate_topology(cls, values):
+        nodes, drives = values.get("nodes", 1), values.get("drives", 1)
+        if nodes < 1 or drives < 1:
+            raise ValueError("Minio needs at least one node with one drive")
+
+        if nodes * drives > 1 and nodes * drives < 4:
+            raise ValueError(f"Distributed minio needs at least 4 drives for erasure coding, got {nodes} nodes with {drives} drives")
+
+        return values
+
+    def depend(self, service: "Service", setup: "Setup"):
         assert hasattr(service, "required_buckets"), f"Service {service.name} needs to require buckets to depend on minio"
         assert hasattr(service, "required_policies"),  f"Service {service.name} needs to require policies to depend on minio"
         
         self.buckets = self.buckets + service.required_buckets
 
-        user = MinioUser(name=service.name, policies=service.required_policies)
+        user = MinioUser(
+            name=service.name,
+            policies=service.required_policies,
+            access_key=setup.generate_secret("username", "services", self.name, "users", service.name),
+            secret_key=setup.generate_secret("password", "services", self.name, "users", service.name),
+        )
         self.users.append(user)
 
         return MinioDepend(
@@ -468,9 +1077,9 @@ class MinioService(GivingService):
             users=self.users,
         )
 
-    def create_fakt(self, setup: "Setup") -> Fakt:
+    def create_fakt(self, setup: "Setup", request: Optional[FaktRequest] = None) -> Fakt:
 
-        base = to_http_base(self.host, self.public_port, internal_port=self.port)
+        base = to_http_base(self.host, self.public_port, internal_port=self.port, request=request)
         return MinioFakt(
             endpoint_url=f"{base}",
             healthz=f"{base}/minio/health/live",
@@ -478,21 +1087,129 @@ class MinioService(GivingService):
     
 
 
+    @property
+    def distributed(self) -> bool:
+        return self.nodes * self.drives > 1
+
+    def node_hosts(self) -> List[str]:
+        return [f"{self.host}{node}" for node in range(1, self.nodes + 1)]
+
+    def create_server_command(self) -> str:
+        drives = f"/data{{1...{self.drives}}}" if self.drives > 1 else "/data1"
+        if self.nodes > 1:
+            command = f"server http://{self.host}{{1...{self.nodes}}}:{self.port}{drives}"
+        elif self.distributed:
+            command = f"server {drives}"
+        else:
+            command = "server /data"
+
+        if self.with_dashboard:
+            command += f" --console-address :{self.public_dashboard_port}"
+
+        return command
+
+    def create_balancer_conf(self, setup: "Setup") -> str:
+        """The nginx config of the front spreading the requests over all nodes"""
+        s3_servers = "".join(f"        server {host}:{self.port};\n" for host in self.node_hosts())
+        conf = (
+            "worker_processes auto;\n"
+            "\n"
+            "events {\n"
+            "    worker_connections 4096;\n"
+            "}\n"
+            "\n"
+            "http {\n"
+            "    upstream minio_s3 {\n"
+            "        least_conn;\n"
+            f"{s3_servers}"
+            "        keepalive 64;\n"
+            "    }\n"
+            "\n"
+            "    server {\n"
+            f"        listen {self.port};\n"
+            "        # Objects (e.g. zarr chunks) are streamed through, never buffered or capped\n"
+            "        ignore_invalid_headers off;\n"
+            "        client_max_body_size 0;\n"
+            "        proxy_buffering off;\n"
+            "        proxy_request_buffering off;\n"
+            "\n"
+            "        location / {\n"
+            "            # The original host keeps presigned urls valid\n"
+            "            proxy_set_header Host $http_host;\n"
+            "            proxy_set_header X-Real-IP $remote_addr;\n"
+            "            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\n"
+            "            proxy_set_header X-Forwarded-Proto $scheme;\n"
+            "            proxy_connect_timeout 300;\n"
+            "            proxy_http_version 1.1;\n"
+            "            proxy_set_header Connection \"\";\n"
+            "            chunked_transfer_encoding off;\n"
+            "            proxy_pass http://minio_s3;\n"
+            "        }\n"
+            "    }\n"
+        )
+
+        if self.with_dashboard:
+            console_servers = "".join(f"        server {host}:{self.public_dashboard_port};\n" for host in self.node_hosts())
+            conf += (
+                "\n"
+                "    upstream minio_console {\n"
+                "        ip_hash;\n"
+                f"{console_servers}"
+                "    }\n"
+                "\n"
+                "    server {\n"
+                f"        listen {self.public_dashboard_port};\n"
+                "        ignore_invalid_headers off;\n"
+                "        client_max_body_size 0;\n"
+                "        proxy_buffering off;\n"
+                "        proxy_request_buffering off;\n"
+                "\n"
+                "        location / {\n"
+                "            proxy_set_header Host $http_host;\n"
+                "            proxy_set_header X-Real-IP $remote_addr;\n"
+                "            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\n"
+                "            proxy_set_header X-Forwarded-Proto $scheme;\n"
+                "            proxy_http_version 1.1;\n"
+                "            proxy_set_header Upgrade $http_upgrade;\n"
+                "            proxy_set_header Connection \"upgrade\";\n"
+                "            chunked_transfer_encoding off;\n"
+                "            proxy_pass http://minio_console;\n"
+                "        }\n"
+                "    }\n"
+            )
+
+        return conf + "}\n"
+
+    def create_files(self, setup: "Setup") -> Dict[str, str]:
+        if not self.distributed:
+            return {}
+
+        return {"configs/minio/nginx.conf": self.create_balancer_conf(setup)}
+
+    def create_docker_volumes(self, setup: "Setup") -> List[DockerVolume]:
+        if not self.distributed or not self.data_path:
+            return []
+
+        return [
+            DockerVolume.from_local(f"{host}_data{drive}", os.path.join(self.data_path, host, f"data{drive}"))
+            for host in self.node_hosts()
+            for drive in range(1, self.drives + 1)
+        ]
+
     def create_docker_services(self, setup: "Setup") -> List[DockerService]:
+        if self.distributed:
+            return self.create_distributed_docker_services(setup)
 
         ports = [f"{self.public_port}:{self.port}"]
 
         if self.with_dashboard:
-            command = f"server /data --console-address :{self.public_dashboard_port}"
             ports.append(f"{self.dashboard_port}:{self.public_dashboard_port}")
-        else:
-            command = f"server /data"
 
         return [
             DockerService(
                 name=self.interface, 
                 image=MINIO_MULTIPLATFORM_IMAGE if setup.multiplatform else MINIO_IMAGE, 
-                command=command,
+                command=self.create_server_command(),
                 ports=ports, 
                 environment={
                     "MINIO_ROOT_USER": self.root_username,
@@ -500,17 +1217,65 @@ class MinioService(GivingService):
                 },
                 depends_on=[],
                 labels=[f"arkitekt.{setup.name}.service=minio"]),
-             DockerService(
-                name="initc", 
-                image=self.init_image, 
-                volumes=[create_config_mount(self.name)],
+            self.create_init_docker_service(setup),
+        ]
+
+    def create_distributed_docker_services(self, setup: "Setup") -> List[DockerService]:
+        """The nodes of the cluster behind a balancer that takes over the name of minio"""
+        ports = [f"{self.public_port}:{self.port}"]
+
+        if self.with_dashboard:
+            ports.append(f"{self.dashboard_port}:{self.public_dashboard_port}")
+
+        docker_services = []
+        for host in self.node_hosts():
+            if self.data_path:
+                volumes = [f"{host}_data{drive}:/data{drive}" for drive in range(1, self.drives + 1)]
+            else:
+                volumes = [f"/data{drive}" for drive in range(1, self.drives + 1)]
+
+            node = DockerService(
+                name=host,
+                image=MINIO_MULTIPLATFORM_IMAGE if setup.multiplatform else MINIO_IMAGE,
+                command=self.create_server_command(),
+                volumes=volumes,
                 environment={
-                    "MINIO_HOST": f"http://minio:{self.port}",
                     "MINIO_ROOT_USER": self.root_username,
                     "MINIO_ROOT_PASSWORD": self.root_password,
                 },
-                depends_on={"minio": {"condition": "service_started"}})
-        ]
+                depends_on=[],
+                labels=[f"arkitekt.{setup.name}.service=minio"])
+            node._scale_as = self.interface
+            docker_services.append(node)
+
+        balancer = DockerService(
+            name=self.interface,
+            image=NGINX_MULTIPLATFORM_IMAGE if setup.multiplatform else NGINX_IMAGE,
+            volumes=["./configs/minio/nginx.conf:/etc/nginx/nginx.conf:ro"],
+            ports=ports,
+            depends_on=self.node_hosts(),
+            labels=[f"arkitekt.{setup.name}.service=minio-balancer"])
+        balancer._scale_as = f"{self.interface}-balancer"
+        docker_services.append(balancer)
+
+        docker_services.append(self.create_init_docker_service(setup))
+        return docker_services
+
+    def create_init_docker_service(self, setup: "Setup") -> DockerService:
+        depends_on = {"minio": {"condition": "service_started"}}
+        for host in self.node_hosts() if self.distributed else []:
+            depends_on[host] = {"condition": "service_started"}
+
+        return DockerService(
+            name="initc", 
+            image=self.init_image, 
+            volumes=[create_config_mount(self.name)],
+            environment={
+                "MINIO_HOST": f"http://minio:{self.port}",
+                "MINIO_ROOT_USER": self.root_username,
+                "MINIO_ROOT_PASSWORD": self.root_password,
+            },
+            depends_on=depends_on)
 
 
     
@@ -536,8 +1301,9 @@ class LokConfig(BaseModel):
     scopes: Dict[str, str]
     public_key: str
     private_key: str
-    apps: List[App]
-    users: List[User]
+    # Streamed into the config by LokService.create_config_streams
+    apps: List[App] = Field(default_factory=list)
+    users: List[User] = Field(default_factory=list)
     groups: List[Group]
     django: DjangoConfig
     deployment: Deployment
@@ -567,6 +1333,7 @@ class LokFakt(Fakt):
     client_secret: str
     grant_type: str 
     name: str 
+    scopes: Optional[List[str]]
 
 SCOPES_REPLACE = """
   scopes: {% for item in client.scopes %}
@@ -576,8 +1343,8 @@ SCOPES_REPLACE = """
 
 class LokService(GivingService, BucketNeedingService):
     name: Literal["lok"]
-    public_key: str = Field(default_factory=lambda: public_key)
-    private_key: str = Field(default_factory=lambda: private_key)
+    public_key: str = None
+    private_key: str = None
     activation_days: int = 7
     token_expire_seconds: int = 60 * 60 * 24 * 7
     scopes: Dict[str, str] = Field(default_factory=lambda: {**DEFAULT_SCOPES})
@@ -589,7 +1356,21 @@ class LokService(GivingService, BucketNeedingService):
     required_buckets: List[Bucket] = Field(default_factory=lambda: [Bucket(name="lokmedia")])
     required_policies: List[str] =  Field(default_factory=lambda: ["readwrite"])
 
-    def depend(self, service: "Service"):
+    @root_validator()
+    def validate_key_pair(cls, values):
+        # Neither is filled from the keystore of the bake (see fill_key_pair)
+        if (values.get("public_key") is None) != (values.get("private_key") is None):
+            raise ValueError("Lok needs both a public and a private key (or neither to use the keystore)")
+
+        return values
+
+    def fill_key_pair(self, keystore: KeyStore):
+        if self.public_key is None and self.private_key is None:
+            pair = keystore.get()
+            self.public_key = pair.public_key
+            self.private_key = pair.private_key
+
+    def depend(self, service: "Service", setup: "Setup"):
         return LokDepend(
             public_key=self.public_key,
             key_type=self.key_type,
@@ -608,20 +1389,13 @@ class LokService(GivingService, BucketNeedingService):
             key_type=self.key_type,
             private_key=self.private_key,
             public_key=self.public_key,
-            users=setup.users,
-            apps=setup.apps,
             groups=setup.groups,
-            django=DjangoConfig(
-                debug=self.dev is True,
-                admin=AdminUser(
-                    username=setup.admin_username,
-                    email=setup.admin_email,
-                    password=setup.admin_password,
-                )
-            ),
+            django=self.create_django_config(setup),
             deployment=Deployment(name=setup.name)
         )
 
+    def create_config_streams(self, setup: "Setup") -> Dict[str, Iterable]:
+        return {"users": setup.iter_users(), "apps": setup.iter_apps()}
     
     def create_raw_fakt(self, setup: "Setup") -> str:
 
@@ -629,7 +1403,7 @@ class LokService(GivingService, BucketNeedingService):
         ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port)   
 
 
-        t = yaml.dump(json.loads(json.dumps({"lok": LokFakt(
+        t = serializer.dump({"lok": LokFakt(
             base_url=f"{base}/o",
             endpoint_url=f"{base}/graphql",
             healthz=f"{base}/ht",
@@ -638,10 +1412,27 @@ class LokService(GivingService, BucketNeedingService):
             client_secret="{{client.client_secret}}",
             grant_type="{{client.authorization_grant_type}}",
             name="{{client.name}}",
-        ).dict()})))
+        )})
 
         return t + SCOPES_REPLACE
 
+    def create_client_fakt(self, setup: "Setup", app: App, request: FaktRequest) -> Fakt:
+
+        base = to_http_base(self.host, self.public_port, internal_port=self.port, request=request)
+        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port, request=request)
+
+        return LokFakt(
+            base_url=f"{base}/o",
+            endpoint_url=f"{base}/graphql",
+            healthz=f"{base}/ht",
+            ws_endpoint_url=f"{ws_base}/graphql",
+            client_id=app.client_id,
+            client_secret=app.client_secret,
+            grant_type=app.grant_type.value,
+            name=app.name,
+            scopes=app.scopes,
+        )
+
 
 
     def create_docker_services(self, setup: "Setup") -> List[DockerService]:
@@ -701,20 +1492,13 @@ class RekuestService(BaseService):
             rabbitmq=self.dependencies["rabbitmq"],
             redis=self.dependencies["redis"],
             db=self.dependencies["db"],
-            django=DjangoConfig(
-                debug=self.dev is True,
-                admin=AdminUser(
-                    username=setup.admin_username,
-                    email=setup.admin_email,
-                    password=setup.admin_password,
-                )
-            )
+            django=self.create_django_config(setup)
         )
 
-    def create_fakt(self, setup: "Setup") -> Fakt:
+    def create_fakt(self, setup: "Setup", request: Optional[FaktRequest] = None) -> Fakt:
 
-        base = to_http_base(self.host, self.public_port, internal_port=self.port)
-        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port)
+        base = to_http_base(self.host, self.public_port, internal_port=self.port, request=request)
+        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port, request=request)
         return RekuestFakt(
             base_url=f"{base}/o",
             endpoint_url=f"{base}/graphql",
@@ -762,9 +1546,9 @@ class HubService(BaseService):
 
         return None
 
-    def create_fakt(self, setup: "Setup") -> Fakt:
-        base = to_http_base(self.host, self.public_port, internal_port=self.port)
-        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port)
+    def create_fakt(self, setup: "Setup", request: Optional[FaktRequest] = None) -> Fakt:
+        base = to_http_base(self.host, self.public_port, internal_port=self.port, request=request)
+        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port, request=request)
         return RekuestFakt(
             base_url=f"{base}/o",
             endpoint_url=f"{base}/graphql",
@@ -841,23 +1625,16 @@ class PortService(BaseService):
             redis=self.dependencies["redis"],
             db=self.dependencies["db"],
             minio=self.dependencies["minio"],
-            django=DjangoConfig(
-                debug=self.dev is True,
-                admin=AdminUser(
-                    username=setup.admin_username,
-                    email=setup.admin_email,
-                    password=setup.admin_password,
-                )
-            ),
+            django=self.create_django_config(setup),
             virtualizer=Virtualizer(
                 network=self.generate_network_name(setup),
             )    
         )
 
-    def create_fakt(self, setup: "Setup") -> Fakt:
+    def create_fakt(self, setup: "Setup", request: Optional[FaktRequest] = None) -> Fakt:
         
-        base = to_http_base(self.host, self.public_port, internal_port=self.port)
-        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port)
+        base = to_http_base(self.host, self.public_port, internal_port=self.port, request=request)
+        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port, request=request)
         return PortFakt(
             base_url=f"{base}/o",
             endpoint_url=f"{base}/graphql",
@@ -933,22 +1710,15 @@ class FlussService(BucketNeedingService):
             lok=self.dependencies["lok"],
             redis=self.dependencies["redis"],
             db=self.dependencies["db"],
-            django=DjangoConfig(
-                debug=self.dev is True,
-                admin=AdminUser(
-                    username=setup.admin_username,
-                    email=setup.admin_email,
-                    password=setup.admin_password,
-                )
-            ),
+            django=self.create_django_config(setup),
             minio=self.dependencies["minio"],
         )
 
-    def create_fakt(self, setup: "Setup") -> Fakt:
+    def create_fakt(self, setup: "Setup", request: Optional[FaktRequest] = None) -> Fakt:
 
         
-        base = to_http_base(self.host, self.public_port, internal_port=self.port)
-        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port)
+        base = to_http_base(self.host, self.public_port, internal_port=self.port, request=request)
+        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port, request=request)
         return FlussFakt(
             base_url=f"{base}/o",
             endpoint_url=f"{base}/graphql",
@@ -1013,19 +1783,12 @@ class MikroService(BaseService):
             redis=self.dependencies["redis"],
             minio=self.dependencies["minio"],
             db=self.dependencies["db"],
-            django=DjangoConfig(
-                debug=self.dev is True,
-                admin=AdminUser(
-                    username=setup.admin_username,
-                    email=setup.admin_email,
-                    password=setup.admin_password,
-                )
-            )
+            django=self.create_django_config(setup)
         )
 
-    def create_fakt(self, setup: "Setup") -> Fakt:
-        base = to_http_base(self.host, self.public_port, internal_port=self.port)
-        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port)
+    def create_fakt(self, setup: "Setup", request: Optional[FaktRequest] = None) -> Fakt:
+        base = to_http_base(self.host, self.public_port, internal_port=self.port, request=request)
+        ws_base = to_ws_base(self.host, self.public_port, internal_port=self.port, request=request)
         return MikroFakt(
             base_url=f"{base}/o",
             endpoint_url=f"{base}/graphql",
@@ -1058,7 +1821,81 @@ class MikroService(BaseService):
 
 
 
-Service = Union[RekuestService, HubService, MinioService, MikroService, RedisService, PostgresService, PortService, FlussService, VscodeService, LokService, RabbitMQService, OrkestratorService]
+def iter_roster(model, roster_file: RosterFile, index: Optional[RosterIndex] = None) -> Iterator[BaseModel]:
+    """Streams the records of a roster file as models
+
+    Invalid records are reported to the index (if given) and skipped.
+    """
+    for number, record in enumerate(iter_records(roster_file.path, roster_file.format), start=1):
+        try:
+            yield model(**record)
+        except pydantic.ValidationError as e:
+            if index is None:
+                raise
+            index.errors.append(f"{roster_file.path} record {number}: {e}")
+
+
+DERIVED_SERVICE_SECRETS = {
+    "postgres": {"username": "username", "password": "password"},
+    "minio": {"root_username": "username", "root_password": "password"},
+}
+
+
+SERVICE_REGISTRY: Dict[str, Type[BaseService]] = {}
+
+
+def register_service(model: Type[BaseService]) -> Type[BaseService]:
+    """Makes a service model available to setups under its literal name
+
+    Can be used as a class decorator by plugins that bring their own
+    services.
+    """
+    names = typing.get_args(model.__fields__["name"].outer_type_)
+    if not names:
+        raise ValueError(f"{model.__name__} needs a Literal name to be registered")
+
+    for name in names:
+        SERVICE_REGISTRY[name] = model
+
+    return model
+
+
+for model in (RekuestService, HubService, MinioService, MikroService, RedisService, PostgresService, PortService, FlussService, VscodeService, LokService, RabbitMQService, OrkestratorService):
+    register_service(model)
+
+
+class Service:
+    """A service of the setup, validated by the model registered for its name
+
+    Unlike a plain Union of the service models this is a single dict lookup
+    and errors point at the fields of the right model.
+    """
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(anyOf=[{"$ref": f"#/definitions/{model.__name__}"} for model in SERVICE_REGISTRY.values()])
+
+    @classmethod
+    def resolve_model(cls, value: Dict) -> Type[BaseService]:
+        name = value.get("name")
+        model = SERVICE_REGISTRY.get(name)
+        if model is None:
+            raise ValueError(f"Unknown service {name!r}, available services are {', '.join(sorted(SERVICE_REGISTRY))}")
+
+        return model
+
+    @classmethod
+    def validate(cls, value: Any) -> BaseService:
+        if isinstance(value, BaseService):
+            return value
+        if not isinstance(value, dict):
+            raise TypeError("A service needs to be a mapping")
+
+        return cls.resolve_model(value)(**value)
 
 
 class Setup(BaseModel):
@@ -1075,80 +1912,203 @@ class Setup(BaseModel):
     users: List[User] = Field(default_factory=list)
     apps: List[App]  = Field(default_factory=list)
 
+    user_roster: Optional[RosterFile] = None
+    app_roster: Optional[RosterFile] = None
+    # Stands in for a missing master secret during a bake, see ensure_local_secret
+    _local_secret: Optional[str] = PrivateAttr(default=None)
+
+    bindings: List[Binding] = Field(default_factory=lambda: [Binding(name="localhost", host="localhost")])
+    # Opt in, it writes a document per app and binding (and streams the roster once per binding)
+    prerender_fakts: bool = False
+
+    scale: Scale = Field(default_factory=Scale)
+    cache: CacheSettings = Field(default_factory=CacheSettings)
+
+    # Every credential derives from it, so it never ends up in a dump (validated.yaml, the api)
+    master_secret: Optional[str] = Field(default_factory=lambda: os.environ.get("GUSS_MASTER_SECRET"), exclude=True)
+
+    @root_validator(pre=True)
+    def derive_secrets(cls, values):
+        """Fills in the secrets that are not set with ones derived from the master secret"""
+        master = values.get("master_secret") or os.environ.get("GUSS_MASTER_SECRET")
+        if not master:
+            return values
+
+        name = values.get("name")
+        apps = []
+        for app in values.get("apps", []):
+            if isinstance(app, dict):
+                app = {**app}
+                for kind in ("client_id", "client_secret", "token"):
+                    if not app.get(kind):
+                        app[kind] = generate_secret(kind, master, f"{name}/apps/{app.get('identifier')}/{app.get('version')}/{kind}")
+            apps.append(app)
+
+        services = []
+        for service in values.get("services", []):
+            if isinstance(service, dict):
+                service = {**service}
+                for field, kind in DERIVED_SERVICE_SECRETS.get(service.get("name"), {}).items():
+                    if not service.get(field):
+                        service[field] = generate_secret(kind, master, f"{name}/services/{service.get('name')}/{field}")
+            services.append(service)
+
+        return {**values, "apps": apps, "services": services}
+
+    @classmethod
+    def schema(cls, by_alias: bool = True, ref_template: str = pydantic.schema.default_ref_template) -> Dict[str, Any]:
+        """The JSON schema, with the definitions of every registered service model"""
+        schema = super().schema(by_alias=by_alias, ref_template=ref_template)
+        services = pydantic.schema.schema(SERVICE_REGISTRY.values(), by_alias=by_alias, ref_template=ref_template)
+        return {**schema, "definitions": {**services.get("definitions", {}), **schema.get("definitions", {})}}
+
+    def generate_secret(self, kind: str, *path: str) -> str:
+        """A secret derived from the master (or local) secret and path, random without either"""
+        return generate_secret(kind, self.master_secret or self._local_secret, "/".join((self.name, *path)))
+
     
     @root_validator()
     def validate_loks_and_apps(cls, values):
-        available_users = [user.username for user in values.get("users", [])]
+        roster = RosterIndex(admin_username=values.get("admin_username"))
 
-        for app in values.get("apps", []):
-            if app.tenant == values["admin_username"]:
-                raise ValueError("App should not be hold by admin account")
+        for group in values.get("groups", []):
+            roster.add_group(group)
+
+        for user in values.get("users", []):
+            roster.add_user(user)
 
-            if app.tenant is None:
-                assert len(available_users) > 0 , "You need to have at least one user installed"
-                app.tenant = available_users[0]
+        if values.get("user_roster"):
+            for user in iter_roster(User, values["user_roster"], roster):
+                roster.add_user(user)
 
-            if app.tenant not in available_users:
+        # Only prerendered fakts build paths from client ids and binding names
+        prerender = values.get("prerender_fakts")
 
-                raise ValueError(f"{app} has unknown tenant dd are {available_users}")
+        for app in itertools.chain(values.get("apps", []), iter_roster(App, values["app_roster"], roster) if values.get("app_roster") else []):
+            roster.add_app(app)
+            if prerender and not SAFE_NAME.match(app.client_id):
+                roster.errors.append(f"App {app.name} has the client_id {app.client_id!r}, prerendered fakts need letters, digits, '.', '-' and '_'")
 
+        for binding in values.get("bindings", []) if prerender else []:
+            if not SAFE_NAME.match(binding.name):
+                roster.errors.append(f"Binding {binding.name!r} needs letters, digits, '.', '-' and '_' for prerendered fakts")
+
+        roster.raise_errors()
         return values
 
+    def first_username(self) -> Optional[str]:
+        for user in self.iter_users():
+            return user.username
+
+        return None
+
+    def iter_users(self) -> Iterator[User]:
+        """The inline users followed by the ones streamed from the user roster"""
+        yield from self.users
+
+        if self.user_roster:
+            for user in iter_roster(User, self.user_roster):
+                user.email = normalize_email(user.email) or user.email
+                yield user
+
+    def ensure_local_secret(self, root: Optional[str] = None):
+        """Provides the secret bake time secrets derive from without a master secret
+
+        With a root it is kept in root/.guss-secret, so roster apps keep their
+        client ids, secrets and tokens and the services their django secret
+        keys across bakes, and unchanged configs are not rewritten. It is set
+        before the setup is pickled to worker processes, which then derive
+        the same secrets as the parent.
+
+        Secrets generated during validation (e.g. database credentials) are
+        kept in validated.yaml, but change when setup.yaml is validated
+        again. Only a master secret keeps them stable across edits.
+        """
+        if self.master_secret is None and self._local_secret is None:
+            self._local_secret = load_local_secret(os.path.join(root, LOCAL_SECRET_FILE)) if root else secrets.token_hex(32)
+
+    def iter_apps(self) -> Iterator[App]:
+        """The inline apps followed by the ones streamed from the app roster
+
+        Secrets missing in the roster are derived from the master secret (or
+        the local secret of the bake), so every pass over the roster, and
+        every bake into the same root, yields the same apps.
+        """
+        yield from self.apps
+
+        if self.app_roster:
+            self.ensure_local_secret()
+            first_username = self.first_username()
+            for record in iter_records(self.app_roster.path, self.app_roster.format):
+                for kind in ("client_id", "client_secret", "token"):
+                    if not record.get(kind):
+                        record[kind] = generate_secret(kind, self.master_secret or self._local_secret, f"{self.name}/apps/{record.get('identifier')}/{record.get('version')}/{kind}")
+
+                app = App(**record)
+                if app.tenant is None:
+                    app.tenant = first_username
+                yield app
+
     @root_validator()
     def validate_admin_not_in_loks(cls, values):
         available_users = [user.username for user in values.get("loks", [])]
 
-        if values["admin_username"] in available_users:
+        if values.get("admin_username") in available_users:
             raise ValueError("Admin can't be a lok user")
 
         return values
 
-    def to_yaml(self, path, dict):
-        with open(path, "w") as f:
-            yaml.dump(remove_none(json.loads(json.dumps(dict))), f)
+    def to_yaml(self, obj) -> str:
+        return serializer.dump(obj)
 
     def resolve(self):
-        os.makedirs("init/configs", exist_ok=True)
+        with tracing.span("resolve"):
+            providers = build_provider_index(self.services)
 
-        for service in self.services:
-            service.resolve(self)
+            for layer in resolution_layers(self.services, providers):
+                for service in layer:
+                    service.resolve(self, providers)
 
 
-    def generate_configs(self):
-        os.makedirs("init/configs", exist_ok=True)
-        
-        for service in self.services:
-            try:
+    def render_config(self, service: BaseService) -> Union[str, Iterator[str], None]:
+        try:
+            with tracing.span("create_config", service=service.name):
                 config = service.create_config(self)
-            except Exception as e:
-                raise Exception(f"Error configuring {service.name}") from e
+                streams = service.create_config_streams(self)
+        except Exception as e:
+            raise Exception(f"Error configuring {service.name}") from e
 
+        if config:
+            return serializer.dump_chunks(config, streams) if streams else self.to_yaml(config)
 
-            if config:
-                self.to_yaml(f"init/configs/{service.name}.yaml", config.dict())
+        return None
 
-        
-    def generate_fakts(self):
-        os.makedirs("init/fakts/linkers", exist_ok=True)
-        os.makedirs("init/fakts/templates", exist_ok=True)
+    def render_configs(self, executor: Optional[Executor] = None) -> Dict[str, str]:
+        if executor:
+            rendered = executor.map(_render_config, range(len(self.services)))
+        else:
+            rendered = (self.render_config(service) for service in self.services)
 
-        fakts = { service.name: service.create_fakt(self) for service in self.services}
+        return {f"configs/{service.name}.yaml": config for service, config in zip(self.services, rendered) if config}
+
+    def render_fakts(self) -> Dict[str, str]:
+        fakts = {}
+        for service in self.services:
+            with tracing.span("create_fakt", service=service.name):
+                fakts[service.name] = service.create_fakt(self)
 
         # TODO configure internal
         wrapped = {"self": {"name": "{{deployment_name}}"}}
-        services = {key: value.dict() for key,value in fakts.items() if value is not None}
+        services = {key: value for key,value in fakts.items() if value is not None}
     
         wrapped.update(services)
 
-        x = yaml.dump(remove_none(json.loads(json.dumps(wrapped))))
+        x = self.to_yaml(wrapped)
         raw_fakts =[service.create_raw_fakt(self) for service in self.services if service.create_raw_fakt(self) is not None]
 
         for t in raw_fakts:
            x += t
 
-        with open("init/fakts/templates/generic.yaml", "w") as f:
-            f.write(x)
-
 
         linker = {
             "name": "Generic Linker",
@@ -1159,31 +2119,215 @@ class Setup(BaseModel):
                 "value": "unallowed"
             }]
         }
-        self.to_yaml(f"init/fakts/linkers/generic.yaml", linker)
 
+        artifacts = {
+            "fakts/templates/generic.yaml": x,
+            "fakts/linkers/generic.yaml": self.to_yaml(linker),
+        }
+
+        if self.prerender_fakts:
+            artifacts.update(self.render_client_fakts())
+
+        return artifacts
+
+    def fakt_requests(self) -> Dict[str, FaktRequest]:
+        requests = {"internal": FaktRequest(host="lok")}
+        for binding in self.bindings:
+            requests[binding.name] = FaktRequest(host=binding.host, secure=binding.ssl)
+
+        return requests
+
+    def render_client_fakts(self) -> Dict[str, str]:
+        """Renders the generic template for every app and binding upfront
+
+        Next to a document per app and binding (fakts/clients/<client_id>/
+        <binding>.yaml) this emits fakts/clients/index.yaml, which maps
+        client_id -> host -> scheme to the document, so serving fakts
+        becomes a lookup instead of rendering the template per request.
+        """
+        artifacts = {}
+        index = {}
+
+        for name, request in self.fakt_requests().items():
+            with tracing.span("create_client_fakts", binding=name):
+                fakts = {"self": {"name": self.name}}
+                for service in self.services:
+                    fakt = service.create_fakt(self, request)
+                    if fakt is not None:
+                        fakts[service.name] = fakt
+
+                # Like the template, the client specific part is appended
+                shared = self.to_yaml(fakts)
+
+                for app in self.iter_apps():
+                    client_fakts = {}
+                    for service in self.services:
+                        fakt = service.create_client_fakt(self, app, request)
+                        if fakt is not None:
+                            client_fakts[service.name] = fakt
+
+                    path = f"fakts/clients/{app.client_id}/{name}.yaml"
+                    artifacts[path] = shared + self.to_yaml(client_fakts) if client_fakts else shared
+                    index.setdefault(app.client_id, {}).setdefault(request.host, {})["https" if request.secure else "http"] = path
+
+        artifacts["fakts/clients/index.yaml"] = self.to_yaml(index)
+        return artifacts
+
+    def render_files(self) -> Dict[str, str]:
+        files = {}
+        for service in self.services:
+            with tracing.span("create_files", service=service.name):
+                files.update(service.create_files(self))
+
+        for docker_service in self.build_docker_services():
+            if docker_service._balances:
+                files[f"configs/balancers/{docker_service._balances}.conf"] = self.create_balancer_conf(docker_service)
+
+        return files
+
+    def render_compose(self) -> Dict[str, str]:
+        docker_compose = DockerCompose(services=self.create_docker_services(), volumes=self.create_docker_volumes(), networks=self.create_networks()
+            , secrets={})
+
+        return {"docker-compose.yaml": self.to_yaml(docker_compose)}
 
+    def write_artifacts(self, sink: Sink, artifacts: Dict[str, str], executor: Optional[Executor] = None):
+        if executor:
+            tracer = tracing.get_tracer()
 
+            def write(item):
+                with tracing.use_tracer(tracer):
+                    return sink.write(*item)
+
+            list(executor.map(write, artifacts.items()))
+        else:
+            for path, content in artifacts.items():
+                sink.write(path, content)
+
+    def generate_configs(self, sink: Sink):
+        self.write_artifacts(sink, self.render_configs())
+
+    def generate_fakts(self, sink: Sink):
+        self.write_artifacts(sink, self.render_fakts())
+
+    def generate_files(self, sink: Sink):
+        self.write_artifacts(sink, self.render_files())
+
+    def generate_compose(self, sink: Sink):
+        self.write_artifacts(sink, self.render_compose())
 
     def generate_dirs(self):
 
         for service in self.services:
             service.create_dirs(self)
 
-    def generate_dev(self):
+    def generate_dev(self, sink: Sink):
         dev_services = [service for service in self.services if service.dev]
 
-        if os.path.exists("init/dev"):
-            shutil.rmtree("init/dev")
-        if len(dev_services) > 0:
-            os.makedirs("init/dev", exist_ok=True)
+        # Only drop the dev dirs of services that are no longer in dev mode
+        sink.sync_dirs("dev", [service.name for service in dev_services])
+
+        for service in dev_services:
+            service.create_dev(self)
 
-            for service in dev_services:
-                service.create_dev(self)
 
 
+    def build_docker_services(self) -> List[DockerService]:
+        docker_services = []
+        for service in self.services:
+            with tracing.span("create_docker_services", service=service.name):
+                docker_services.extend(service.create_docker_services(self))
+
+        for service in self.services:
+            service.patch_docker_services(self, docker_services)
+
+        balancers = []
+        for docker_service in docker_services:
+            balancer = self.apply_scale(docker_service)
+            if balancer is not None:
+                balancers.append(balancer)
+
+        return docker_services + balancers
 
     def create_docker_services(self) -> Dict :
-        return {d.name: d.dict(exclude={"name"}) for d in itertools.chain(*(service.create_docker_services(self) for service in self.services))}
+        return {d.name: d.dict(exclude={"name"}) for d in self.build_docker_services()}
+
+    def apply_scale(self, docker_service: DockerService) -> Optional[DockerService]:
+        """Scales docker_service, returns the balancer in front of its replicas if it needs one"""
+        scale = self.scale.for_service(docker_service._scale_as or docker_service.name)
+        if scale is None:
+            return None
+
+        docker_service.deploy = scale.to_deploy()
+
+        if scale.workers:
+            docker_service.environment = {**(docker_service.environment or {}), "WEB_CONCURRENCY": str(scale.workers)}
+
+        # Replicas can't share a host port, a balancer publishes it and spreads the requests over them
+        published = [port for port in docker_service.ports or [] if ":" in port]
+        if scale.replicas and scale.replicas > 1 and published:
+            docker_service.ports = [port for port in docker_service.ports if port not in published]
+
+            balancer = DockerService(
+                name=f"{docker_service.name}-balancer",
+                image=NGINX_MULTIPLATFORM_IMAGE if self.multiplatform else NGINX_IMAGE,
+                ports=published,
+                volumes=[f"./configs/balancers/{docker_service.name}.conf:/etc/nginx/nginx.conf:ro"],
+                depends_on=[docker_service.name],
+                labels=[f"arkitekt.{self.name}.service={docker_service.name}-balancer"])
+            balancer._balances = docker_service.name
+            return balancer
+
+        return None
+
+    def create_balancer_conf(self, balancer: DockerService) -> str:
+        """The nginx config of a balancer, forwarding every published port to the replicas"""
+        servers = ""
+        for port in balancer.ports:
+            internal = port.rpartition(":")[2]
+            servers += (
+                "\n"
+                "    server {\n"
+                f"        listen {internal};\n"
+                "\n"
+                "        location / {\n"
+                f"            set $upstream http://{balancer._balances}:{internal};\n"
+                "            proxy_pass $upstream;\n"
+                "            proxy_http_version 1.1;\n"
+                "            proxy_set_header Upgrade $http_upgrade;\n"
+                "            proxy_set_header Connection $connection_upgrade;\n"
+                "            # The services tell internal and external requests apart by their host\n"
+                "            proxy_set_header Host $http_host;\n"
+                "            proxy_set_header X-Real-IP $remote_addr;\n"
+                "            proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;\n"
+                "            proxy_set_header X-Forwarded-Proto $scheme;\n"
+                "            proxy_read_timeout 3600s;\n"
+                "        }\n"
+                "    }\n"
+            )
+
+        return (
+            "worker_processes auto;\n"
+            "\n"
+            "events {\n"
+            "    worker_connections 4096;\n"
+            "}\n"
+            "\n"
+            "http {\n"
+            "    # Resolved through the docker dns per request, so every (restarted) replica gets traffic\n"
+            "    resolver 127.0.0.11 valid=10s ipv6=off;\n"
+            "\n"
+            "    map $http_upgrade $connection_upgrade {\n"
+            "        default upgrade;\n"
+            "        '' close;\n"
+            "    }\n"
+            "\n"
+            "    client_max_body_size 0;\n"
+            "    proxy_buffering off;\n"
+            "    proxy_request_buffering off;\n"
+            f"{servers}"
+            "}\n"
+        )
 
     def create_docker_volumes(self) -> Dict:
         return {d.name: d.dict(exclude={"name"}) for d in itertools.chain(*(service.create_docker_volumes(self) for service in self.services))}
@@ -1194,17 +2338,72 @@ class Setup(BaseModel):
         return additional
     
 
-    def bake(self):
+    def fill_key_pairs(self, root: Optional[str] = None):
+        """Fills the keys left unset from the ambient keystore or the keyfile under root"""
+        keystore = get_keystore()
+        if keystore is None:
+            keystore = KeyStore(os.environ.get("GUSS_KEYFILE") or (os.path.join(root, KEYFILE) if root else None))
 
-        self.resolve()
-        self.generate_dirs()
-        self.generate_configs()
-        self.generate_fakts()
-        self.generate_dev()
+        for service in self.services:
+            if isinstance(service, LokService):
+                service.fill_key_pair(keystore)
 
+    def bake(self, root: str = "init", workers: Optional[int] = None, processes: Optional[int] = None, sink: Optional[Sink] = None) -> Sink:
+        """Bakes the setup into sink (by default a DirectorySink of root)
+
+        With `workers` the artifacts are written from a thread pool and with
+        `processes` the per service configs are rendered in a process pool.
+        Both produce the exact same files as the serial bake.
+        """
+        if sink is None:
+            sink = DirectorySink(root)
+
+        with tracing.span("bake", root=root, sink=type(sink).__name__):
+            self.fill_key_pairs(root if isinstance(sink, DirectorySink) else None)
+
+            for service in self.services:
+                # Sorted, a trusted reload brings dicts back in the (sorted) order of validated.yaml
+                sink.record_service(service.name, service.json(exclude={"dependencies"}, sort_keys=True))
+
+            self.ensure_local_secret(root if isinstance(sink, DirectorySink) else None)
+            self.resolve()
+            self.generate_dirs()
+
+            if not workers and not processes:
+                self.generate_configs(sink)
+                self.generate_files(sink)
+                self.generate_fakts(sink)
+                self.generate_dev(sink)
+                self.generate_compose(sink)
+
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+
+                with contextlib.ExitStack() as stack:
+                    render_pool = stack.enter_context(ProcessPoolExecutor(processes, initializer=_set_render_setup, initargs=(self,))) if processes else None
+                    write_pool = stack.enter_context(ThreadPoolExecutor(workers)) if workers else None
+
+                    artifacts = self.render_configs(render_pool)
+                    artifacts.update(self.render_files())
+                    artifacts.update(self.render_fakts())
+                    artifacts.update(self.render_compose())
+
+                    self.write_artifacts(sink, artifacts, write_pool)
+                    self.generate_dev(sink)
+
+            sink.prune()
+            sink.save()
+        return sink
+
+
+_render_setup: Optional[Setup] = None
+
+
+def _set_render_setup(setup: Setup):
+    global _render_setup
+    _render_setup = setup
 
-        docker_compose = DockerCompose(services=self.create_docker_services(), volumes=self.create_docker_volumes(), networks=self.create_networks()
-            , secrets={})
-        
-        self.to_yaml("init/docker-compose.yaml", docker_compose.dict()) 
 
+def _render_config(index: int) -> Optional[str]:
+    config = _render_setup.render_config(_render_setup.services[index])
+    return config if config is None or isinstance(config, str) else "".join(config)
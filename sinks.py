@@ -0,0 +1,217 @@
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+from typing import IO, Dict, Iterable, List, Optional, Set, Union
+
+import tracing
+from manifest import BakeManifest
+
+
+Content = Union[str, Iterable[str]]
+
+
+def to_bytes(content: Content) -> bytes:
+    if isinstance(content, str):
+        return content.encode()
+
+    return "".join(content).encode()
+
+
+def check_path(path: str) -> str:
+    """Rejects paths that would leave the init tree"""
+    if os.path.isabs(path) or ".." in path.replace("\\", "/").split("/"):
+        raise ValueError(f"Refusing to write {path}, it leaves the init tree")
+
+    return path
+
+
+class Sink:
+    """Where a bake puts its artifacts (paths are relative to the init tree)"""
+
+    def __init__(self):
+        self.written: List[str] = []
+        self.services: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def write(self, path: str, content: Content) -> bool:
+        """Writes content to path
+
+        Returns:
+            bool: Whether the artifact changed
+        """
+        raise NotImplementedError
+
+    def sync_dirs(self, path: str, names: Iterable[str]):
+        """Keeps only the directories names under path (and path if there are any)"""
+        pass
+
+    def record_service(self, name: str, content: str):
+        self.services[name] = hashlib.sha256(content.encode()).hexdigest()
+
+    def prune(self):
+        pass
+
+    def save(self):
+        pass
+
+
+class DirectorySink(Sink):
+    """Writes the artifacts under root, only touching the files that changed
+
+    What changed is told by the manifest of the previous bake, which is
+    updated on `save`.
+    """
+
+    def __init__(self, root: str = "init"):
+        super().__init__()
+        self.root = root
+        self.manifest = BakeManifest(root)
+        # The manifest keeps track of what was written and of the services
+        self.written = self.manifest.written
+        self.services = self.manifest.services
+
+    def write(self, path: str, content: Content) -> bool:
+        return self.manifest.write(check_path(path), content)
+
+    def record_service(self, name: str, content: str):
+        self.manifest.record_service(name, content)
+
+    def changed_services(self) -> List[str]:
+        return self.manifest.changed_services()
+
+    def prune(self):
+        self.manifest.prune()
+
+    def save(self):
+        self.manifest.save()
+
+    def sync_dirs(self, path: str, names: Iterable[str]):
+        names = set(names)
+        full_path = os.path.join(self.root, path)
+
+        if os.path.exists(full_path):
+            for entry in os.listdir(full_path):
+                if entry not in names:
+                    shutil.rmtree(os.path.join(full_path, entry))
+
+        if names:
+            os.makedirs(full_path, exist_ok=True)
+        elif os.path.exists(full_path):
+            shutil.rmtree(full_path)
+
+
+class MemorySink(Sink):
+    """Keeps the artifacts in a dict of path -> bytes, nothing touches the disk"""
+
+    def __init__(self, files: Optional[Dict[str, bytes]] = None):
+        super().__init__()
+        self.files: Dict[str, bytes] = dict(files or {})
+        self.dirs: Set[str] = set()
+
+    def write(self, path: str, content: Content) -> bool:
+        check_path(path)
+        data = to_bytes(content)
+
+        with tracing.span("write", path=path, bytes=len(data)):
+            with self._lock:
+                changed = self.files.get(path) != data
+                self.files[path] = data
+                if changed:
+                    self.written.append(path)
+
+        return changed
+
+    def sync_dirs(self, path: str, names: Iterable[str]):
+        if list(names):
+            self.dirs.add(path)
+        else:
+            self.dirs.discard(path)
+
+    def read(self, path: str) -> str:
+        return self.files[path].decode()
+
+
+class ArchiveSink(Sink):
+    """Streams the artifacts into a tar (optionally gzipped) or zip archive
+
+    The archive is written sequentially, so stream can be a pipe or a socket
+    (e.g. sys.stdout.buffer). Every path is placed under prefix. The archive
+    is finished on `save`.
+    """
+
+    def __init__(self, stream: IO[bytes], format: str = "tar", prefix: str = "init"):
+        super().__init__()
+        self.format = format
+        self.prefix = prefix
+        self.mtime = time.time()
+
+        if format == "zip":
+            self._zip = zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED)
+            self._tar = None
+        elif format in ("tar", "tar.gz"):
+            self._tar = tarfile.open(fileobj=stream, mode="w|gz" if format == "tar.gz" else "w|")
+            self._zip = None
+        else:
+            raise ValueError(f"Unknown archive format {format}, use tar, tar.gz or zip")
+
+    def _name(self, path: str) -> str:
+        check_path(path)
+        return f"{self.prefix}/{path}" if self.prefix else path
+
+    def write(self, path: str, content: Content) -> bool:
+        data = to_bytes(content)
+
+        with tracing.span("write", path=path, bytes=len(data)):
+            with self._lock:
+                if self._zip is not None:
+                    info = zipfile.ZipInfo(self._name(path), time.localtime(self.mtime)[:6])
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    info.external_attr = 0o644 << 16
+                    self._zip.writestr(info, data)
+                else:
+                    info = tarfile.TarInfo(self._name(path))
+                    info.size = len(data)
+                    info.mtime = self.mtime
+                    info.mode = 0o644
+                    self._tar.addfile(info, io.BytesIO(data))
+
+                self.written.append(path)
+
+        return True
+
+    def sync_dirs(self, path: str, names: Iterable[str]):
+        if not list(names):
+            return
+
+        with self._lock:
+            if self._zip is not None:
+                info = zipfile.ZipInfo(self._name(path) + "/", time.localtime(self.mtime)[:6])
+                info.external_attr = (0o40755 << 16) | 0x10
+                self._zip.writestr(info, b"")
+            else:
+                info = tarfile.TarInfo(self._name(path))
+                info.type = tarfile.DIRTYPE
+                info.mtime = self.mtime
+                info.mode = 0o755
+                self._tar.addfile(info)
+
+    def save(self):
+        with self._lock:
+            if self._zip is not None:
+                self._zip.close()
+            else:
+                self._tar.close()
+
+
+def archive_format(path: str) -> str:
+    """The archive format for an output path (by its suffix)"""
+    if path.endswith(".zip"):
+        return "zip"
+    if path.endswith((".tar.gz", ".tgz")):
+        return "tar.gz"
+    return "tar"
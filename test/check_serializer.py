@@ -0,0 +1,96 @@
+"""Checks that the serializer bakes the same bytes as the old json round trip
+
+Bakes test/setup.yaml (with a fixed master secret) twice into memory, once
+through `serializer` and once through the `.dict() -> json -> remove_none ->
+yaml.dump` chain it replaced, and compares every artifact and validated.yaml
+byte for byte. Exits non zero on a difference:
+
+    python test/check_serializer.py
+    python test/check_serializer.py --setup path/to/setup.yaml
+"""
+import argparse
+import json
+import os
+import sys
+
+import yaml
+from pydantic.json import pydantic_encoder
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import serializer  # noqa: E402
+import yamlio  # noqa: E402
+from keystore import KeyStore, use_keystore  # noqa: E402
+from setup import Setup  # noqa: E402
+from sinks import MemorySink  # noqa: E402
+from utils import guard_empty  # noqa: E402
+
+MASTER_SECRET = "check-serializer-master-secret"
+
+
+def remove_none(obj):
+    if isinstance(obj, (list, tuple, set)):
+        return type(obj)(remove_none(x) for x in obj if guard_empty(x))
+    elif isinstance(obj, dict):
+        return type(obj)((k, remove_none(v)) for k, v in obj.items() if k and guard_empty(v))
+    else:
+        return obj
+
+
+def round_trip(obj, stream=None, prune=True):
+    plain = json.loads(json.dumps(obj, default=pydantic_encoder))
+
+    if not prune:
+        return yaml.safe_dump(plain, stream)
+
+    return yaml.dump(remove_none(plain), stream)
+
+
+def round_trip_chunks(obj, streams, prune=True):
+    plain = json.loads(json.dumps(obj, default=pydantic_encoder))
+    plain.update({key: json.loads(json.dumps(list(items), default=pydantic_encoder)) for key, items in streams.items()})
+
+    yield yaml.dump(remove_none(plain)) if prune else yaml.safe_dump(plain)
+
+
+def bake(setup: Setup) -> MemorySink:
+    sink = setup.bake(sink=MemorySink())
+    sink.write("validated.yaml", serializer.dump(setup, prune=False))
+    return sink
+
+
+def bake_round_trip(setup: Setup) -> MemorySink:
+    dump, dump_chunks = serializer.dump, serializer.dump_chunks
+    serializer.dump, serializer.dump_chunks = round_trip, round_trip_chunks
+    try:
+        return bake(setup)
+    finally:
+        serializer.dump, serializer.dump_chunks = dump, dump_chunks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--setup", default=os.path.join(ROOT, "test", "setup.yaml"))
+    args = parser.parse_args()
+
+    with open(args.setup, "r") as f:
+        config = yamlio.load(f)
+
+    config["master_secret"] = MASTER_SECRET
+
+    # Resolving adds to the services, so every bake gets a setup of its own.
+    # Both share one (in memory) key pair.
+    with use_keystore(KeyStore()):
+        new = bake(Setup(**config))
+        old = bake_round_trip(Setup(**config))
+
+    differing = sorted(path for path in set(old.files) | set(new.files) if old.files.get(path) != new.files.get(path))
+
+    for path in differing:
+        print(f"differs: {path}", file=sys.stderr)
+
+    if differing:
+        sys.exit(1)
+
+    print(f"{len(new.files)} artifacts are byte identical")
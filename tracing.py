@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+
+class Span:
+    __slots__ = ("name", "start", "duration", "thread", "attrs", "peak_memory", "_carried_peak")
+
+    def __init__(self, name: str, attrs: Dict):
+        self.name = name
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.peak_memory: Optional[int] = None
+        self._carried_peak = 0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin: float) -> Dict:
+        return {
+            "name": self.name,
+            "start": self.start - origin,
+            "duration": self.duration,
+            "thread": self.thread,
+            "peak_memory": self.peak_memory,
+            **self.attrs,
+        }
+
+
+class Tracer:
+    """Records spans (duration, attributes and optionally peak memory)
+
+    Peak memory is measured with tracemalloc, which slows the traced code
+    down considerably and is therefore opt-in. On Python < 3.9 (no
+    tracemalloc.reset_peak) the peak is the process peak up to the end of
+    the span. Spans recorded in other processes (e.g. a render pool) are
+    not collected.
+    """
+
+    def __init__(self, memory: bool = False):
+        self.memory = memory
+        self.spans: List[Span] = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        span = Span(name, attrs)
+        stack = self._local.__dict__.setdefault("stack", [])
+
+        if self.memory:
+            if stack:
+                stack[-1]._carried_peak = max(stack[-1]._carried_peak, tracemalloc.get_traced_memory()[1])
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            span.duration = time.perf_counter() - span.start
+
+            if self.memory:
+                span.peak_memory = max(span._carried_peak, tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1]._carried_peak = max(stack[-1]._carried_peak, span.peak_memory)
+
+            with self._lock:
+                self.spans.append(span)
+
+    def to_json(self) -> Dict:
+        return {"spans": [span.to_dict(self.origin) for span in sorted(self.spans, key=lambda span: span.start)]}
+
+    def to_chrome(self) -> Dict:
+        """Chrome trace event format (chrome://tracing, perfetto)"""
+        pid = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": (span.start - self.origin) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": pid,
+                    "tid": span.thread,
+                    "args": {"peak_memory": span.peak_memory, **span.attrs},
+                }
+                for span in sorted(self.spans, key=lambda span: span.start)
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def export(self, path: str, format: str = "json"):
+        with open(path, "w") as f:
+            json.dump(self.to_chrome() if format == "chrome" else self.to_json(), f, indent=2)
+
+
+class _NullSpan:
+    def set(self, **attrs):
+        pass
+
+
+class NullTracer:
+    """The default tracer, spans cost next to nothing"""
+
+    _span = _NullSpan()
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        yield self._span
+
+
+_current_tracer: ContextVar = ContextVar("tracer", default=NullTracer())
+
+
+def get_tracer():
+    return _current_tracer.get()
+
+
+@contextmanager
+def use_tracer(tracer):
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+
+
+def span(name: str, **attrs):
+    return _current_tracer.get().span(name, **attrs)
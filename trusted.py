@@ -0,0 +1,128 @@
+import hashlib
+import inspect
+import os
+import typing
+from enum import Enum
+from typing import Any, Dict, Iterable, Optional, Type, TypeVar
+
+from pydantic import BaseModel
+
+import yamlio
+
+
+# Bump when the layout of validated.yaml changes in a way construct can't follow
+FORMAT_VERSION = "2"
+
+HASH_PREFIX = "# source-sha256: "
+
+T = TypeVar("T", bound=BaseModel)
+
+
+def master_secret(source: bytes) -> Optional[str]:
+    """The master secret a setup is validated with (from source or the environment)
+
+    validated.yaml never contains it, so a trusted setup gets it from here.
+    """
+    if b"master_secret" in source:
+        data = yamlio.safe_load(source)
+        if isinstance(data, dict) and data.get("master_secret"):
+            return data["master_secret"]
+
+    return os.environ.get("GUSS_MASTER_SECRET") or None
+
+
+def source_hash(source: bytes, paths: Iterable[str] = ()) -> str:
+    """The fingerprint of everything a validated setup was derived from
+
+    Besides the setup itself this covers the (hashed) master secret and the
+    stat of referenced files (e.g. rosters), so changing any of them
+    invalidates the trusted copy.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(FORMAT_VERSION.encode())
+    hasher.update(source)
+    hasher.update(hashlib.sha256((master_secret(source) or "").encode()).digest())
+
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            hasher.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        except OSError:
+            hasher.update(f"{path}:missing".encode())
+
+    return hasher.hexdigest()
+
+
+def read_hash(path: str) -> Optional[str]:
+    """The source hash a trusted file was written with (its first line)"""
+    try:
+        with open(path, "r") as f:
+            line = f.readline()
+    except OSError:
+        return None
+
+    if line.startswith(HASH_PREFIX):
+        return line[len(HASH_PREFIX):].strip()
+
+    return None
+
+
+def _discriminate(options, value: Dict):
+    """Picks the model of a Union whose literal name matches"""
+    for option in options:
+        if inspect.isclass(option) and issubclass(option, BaseModel):
+            field = option.__fields__.get("name")
+            if field is not None and value.get("name") in typing.get_args(field.outer_type_):
+                return option
+
+    return None
+
+
+def construct_value(type_: Any, value: Any) -> Any:
+    if value is None:
+        return None
+
+    origin = typing.get_origin(type_)
+
+    if origin is typing.Union:
+        options = [option for option in typing.get_args(type_) if option is not type(None)]
+        if len(options) == 1:
+            return construct_value(options[0], value)
+        if isinstance(value, dict):
+            option = _discriminate(options, value)
+            if option is not None:
+                return construct(option, value)
+        return value
+
+    if origin is list:
+        (item_type,) = typing.get_args(type_) or (Any,)
+        return [construct_value(item_type, item) for item in value]
+
+    if origin is dict:
+        _, item_type = typing.get_args(type_) or (Any, Any)
+        return {key: construct_value(item_type, item) for key, item in value.items()}
+
+    if inspect.isclass(type_):
+        if hasattr(type_, "resolve_model") and isinstance(value, dict):
+            return construct(type_.resolve_model(value), value)
+        if issubclass(type_, BaseModel) and isinstance(value, dict):
+            return construct(type_, value)
+        if issubclass(type_, Enum):
+            return type_(value)
+
+    return value
+
+
+def construct(model: Type[T], data: Dict) -> T:
+    """Rebuilds a model tree from data we validated and dumped ourselves
+
+    Like BaseModel.construct, but nested models, lists of models and the
+    services (by their registered name) are rebuilt too. Nothing is validated, so only
+    ever pass data that went through full validation before.
+    """
+    values = {}
+    for name, field in model.__fields__.items():
+        if field.alias in data:
+            values[name] = construct_value(field.outer_type_, data[field.alias])
+
+    return model.construct(**values)
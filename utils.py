@@ -1,4 +1,4 @@
-
+import re
 
 
 def create_config_mount(service: str):
@@ -20,11 +20,15 @@ def guard_empty(obj):
     return not ((obj is None) or (isinstance(obj, (dict, list, tuple, set)) and len(obj) == 0))
 
 
-def remove_none(obj):
-  if isinstance(obj, (list, tuple, set)):
-    return type(obj)(remove_none(x) for x in obj if guard_empty(x))
-  elif isinstance(obj, dict):
-    return type(obj)((k, remove_none(v))
-      for k, v in obj.items() if k and guard_empty(v))
-  else:
-    return obj
+SIZE_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?$")
+
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """Parses a docker style size (e.g. 512m, 2g or 2GB) into bytes"""
+    match = SIZE_PATTERN.match(size.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid size {size}, use e.g. 512m or 2g")
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
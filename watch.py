@@ -0,0 +1,259 @@
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import trusted
+from keystore import KEYFILE, KeyStore, use_keystore
+from main import load_setup, load_trusted, roster_paths, write_validated
+from sinks import DirectorySink
+
+
+logger = logging.getLogger(__name__)
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class PollingWatcher:
+    """Notices changes of files by polling their stat"""
+
+    def __init__(self, paths: Iterable[str], interval: float = 0.5):
+        self.interval = interval
+        self.stats: Dict[str, Optional[Tuple]] = {}
+        self.watch(paths)
+
+    def _stat(self, path: str) -> Optional[Tuple]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def watch(self, paths: Iterable[str]):
+        self.stats = {path: self.stats[path] if path in self.stats else self._stat(path) for path in paths}
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until a watched file changed (True) or timeout passed (False)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = False
+            for path, previous in self.stats.items():
+                current = self._stat(path)
+                if current != previous:
+                    self.stats[path] = current
+                    changed = True
+
+            if changed:
+                return True
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """Notices changes of files through inotify (Linux only)
+
+    The directories of the files are watched, so editors that save by
+    replacing the file are noticed as well.
+    """
+
+    def __init__(self, paths: Iterable[str]):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.dirs: Dict[int, str] = {}
+        self.names: Dict[str, set] = {}
+        self.watch(paths)
+
+    def watch(self, paths: Iterable[str]):
+        for path in paths:
+            directory, name = os.path.split(os.path.abspath(path))
+            if directory not in self.names:
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"Could not watch {directory}")
+                self.dirs[wd] = directory
+                self.names[directory] = set()
+            self.names[directory].add(name)
+
+    def _read(self) -> bool:
+        changed = False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0").decode()
+            offset += EVENT_HEADER.size + length
+
+            directory = self.dirs.get(wd)
+            if directory is not None and name in self.names[directory]:
+                changed = True
+
+        return changed
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until a watched file changed (True) or timeout passed (False)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if readable and self._read():
+                return True
+            if not readable:
+                return False
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(paths: List[str], poll: bool = False, interval: float = 0.5):
+    if not poll:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as e:
+            logger.info("Falling back to polling (%s)", e)
+
+    return PollingWatcher(paths, interval)
+
+
+class BakeLoop:
+    """Keeps the setup warm and rebakes root whenever setup.yaml changes
+
+    The keystore, the imported modules and the last valid setup stay in
+    memory. Thanks to the manifest only the artifacts whose content changed
+    are written, an invalid setup is reported and the last bake is kept.
+    """
+
+    def __init__(self, root: str = "init", **bake_kwargs):
+        self.root = root
+        self.path = os.path.join(root, "setup.yaml")
+        self.validated_path = os.path.join(root, "validated.yaml")
+        self.bake_kwargs = bake_kwargs
+        # The key of this deployment, not the one of ./init
+        self.keystore = KeyStore(os.path.join(root, KEYFILE))
+        self.source_hash: Optional[str] = None
+        self.baked_hash: Optional[str] = None
+        self.setup = None
+        self.sink: Optional[DirectorySink] = None
+
+    def paths(self) -> List[str]:
+        return [self.path, *(roster_paths(self.setup) if self.setup else [])]
+
+    def bake(self) -> Optional[DirectorySink]:
+        """Rebakes if the setup changed since the last bake"""
+        start = time.perf_counter()
+        try:
+            with open(self.path, "rb") as f:
+                source = f.read()
+        except OSError as e:
+            logger.error("Not baking, could not read %s: %s", self.path, e)
+            return None
+
+        with use_keystore(self.keystore):
+            return self._bake(source, start)
+
+    def _bake(self, source: bytes, start: float) -> Optional[DirectorySink]:
+        if self.setup is None:
+            self.setup = load_trusted(source, self.validated_path)
+            self.source_hash = trusted.read_hash(self.validated_path) if self.setup else None
+
+        setup, source_hash, validated = self.setup, self.source_hash, False
+        if setup is None or source_hash != trusted.source_hash(source, roster_paths(setup)):
+            try:
+                setup = load_setup(self.path)
+            except Exception as e:
+                logger.error("Not baking, %s is invalid: %s", self.path, e)
+                return None
+
+            source_hash = trusted.source_hash(source, roster_paths(setup))
+            validated = True
+
+        elif source_hash == self.baked_hash:
+            logger.debug("%s did not change", self.path)
+            return None
+
+        try:
+            sink = setup.bake(self.root, **self.bake_kwargs)
+        except Exception as e:
+            # E.g. services that validate but can't be resolved, keep the last bake
+            logger.exception("Not baking, %s could not be baked: %s", self.path, e)
+            return None
+
+        # Only trust a setup that baked
+        if validated:
+            write_validated(setup, self.root, source_hash)
+
+        self.setup, self.source_hash, self.baked_hash, self.sink = setup, source_hash, source_hash, sink
+        logger.warning("Baked in %.3fs, %d artifacts changed (services: %s)", time.perf_counter() - start, len(sink.written), ", ".join(sink.changed_services()) or "none")
+        return sink
+
+    def run(self, poll: bool = False, interval: float = 0.5, debounce: float = 0.2):
+        self.bake()
+        watcher = open_watcher(self.paths(), poll=poll, interval=interval)
+        logger.warning("Watching %s with %s", self.path, type(watcher).__name__)
+
+        try:
+            while True:
+                watcher.wait()
+                # Editors tend to write in bursts, wait until it settled
+                while watcher.wait(debounce):
+                    pass
+
+                self.bake()
+                watcher.watch(self.paths())
+        finally:
+            watcher.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Rebakes init whenever init/setup.yaml changes")
+    parser.add_argument("--root", default="init", help="The directory with setup.yaml to bake into")
+    parser.add_argument("--poll", action="store_true", help="Poll for changes instead of using inotify")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between polls")
+    parser.add_argument("--debounce", type=float, default=0.2, help="Seconds without changes before rebaking")
+    parser.add_argument("--workers", type=int, default=None, help="Write artifacts from a thread pool of this size")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(message)s")
+
+    try:
+        BakeLoop(args.root, workers=args.workers).run(poll=args.poll, interval=args.interval, debounce=args.debounce)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,25 @@
+from typing import Any, IO, Optional, Union
+
+import yaml
+
+
+# libyaml backed loaders and dumpers if PyYAML was built with it
+try:
+    from yaml import CBaseLoader as BaseLoader, CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import BaseLoader, SafeLoader, SafeDumper
+
+
+def load(stream: Union[str, IO]) -> Any:
+    """Loads a setup document, every scalar is kept as a string (like yaml.BaseLoader)"""
+    return yaml.load(stream, BaseLoader)
+
+
+def safe_load(stream: Union[str, IO]) -> Any:
+    """Loads a document we dumped ourselves, with its scalars typed"""
+    return yaml.load(stream, SafeLoader)
+
+
+def dump(data: Any, stream: Optional[IO] = None) -> Optional[str]:
+    """Dumps plain data (like yaml.safe_dump)"""
+    return yaml.dump(data, stream, Dumper=SafeDumper)